@@ -0,0 +1,69 @@
+import argparse
+import random
+import time
+from io import BytesIO
+
+from pyy_chr.core.bitplane_interpreter import decode_bitplanes
+
+
+# Copy of the original per-pixel decoder, kept as the reference for correctness and speed comparisons.
+def decode_bitplanes_reference(data, interleaved_row_count: int, layer_count: int) -> bytes:
+    bytes_per_page = 8 * interleaved_row_count * layer_count
+
+    in_data = BytesIO(data)
+    out_data = BytesIO()
+
+    while True:
+        page_data = in_data.read(bytes_per_page)
+        if len(page_data) < bytes_per_page:
+            break
+
+        for y in range(8):
+            for x in range(8):
+                bitplane = 0
+                val = 0
+
+                for layer in range(layer_count):
+                    layer_start = layer * interleaved_row_count * 8
+                    for interleave in range(interleaved_row_count):
+                        bit = (page_data[layer_start + y * interleaved_row_count + interleave] >> (7 - x)) & 1
+                        val |= bit << bitplane
+                        bitplane += 1
+
+                out_data.write(val.to_bytes(1, byteorder='big'))
+
+    return out_data.getvalue()
+
+
+def _time(func, *args) -> float:
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Compare the vectorized bit-plane decoder against the reference loop.')
+    parser.add_argument('--size', type=int, default=512 * 1024, help='Buffer size in bytes.')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    raw = random.Random(args.seed).randbytes(args.size)
+
+    for interleaved_row_count in range(1, 9):
+        for layer_count in range(1, 8 // interleaved_row_count + 1):
+
+            expected = decode_bitplanes_reference(raw, interleaved_row_count, layer_count)
+            actual = decode_bitplanes(raw, interleaved_row_count, layer_count).tobytes()
+            if expected != actual:
+                raise Exception('Mismatch for interleaved={0}, layers={1}'.format(interleaved_row_count, layer_count))
+
+            reference_time = _time(decode_bitplanes_reference, raw, interleaved_row_count, layer_count)
+            vectorized_time = _time(decode_bitplanes, raw, interleaved_row_count, layer_count)
+
+            print('interleaved={0} layers={1}: reference {2:8.3f}s  vectorized {3:8.4f}s  ({4:.0f}x)'.format(
+                interleaved_row_count, layer_count, reference_time, vectorized_time,
+                reference_time / max(vectorized_time, 1e-9)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+import argparse
+import json
+import sys
+from typing import List
+
+# Result fields that identify a case rather than measure it.
+KEY_FIELDS = ('name', 'format', 'rom_bytes', 'map_cells')
+
+
+def _key(result: dict) -> tuple:
+    return tuple(result.get(field) for field in KEY_FIELDS)
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description='Compare two benchmark JSON reports written by benchmarks/run.py.')
+    parser.add_argument('baseline')
+    parser.add_argument('candidate')
+    parser.add_argument('--threshold', type=float, default=1.10,
+                        help='Flag cases at least this many times slower. Default: 1.10.')
+    args = parser.parse_args(argv)
+
+    with open(args.baseline) as baseline_file, open(args.candidate) as candidate_file:
+        baseline = {_key(result): result for result in json.load(baseline_file)['results']}
+        candidate = {_key(result): result for result in json.load(candidate_file)['results']}
+
+    regressions = 0
+    for key in sorted(set(baseline) & set(candidate), key=str):
+        ratio = candidate[key]['seconds'] / baseline[key]['seconds']
+        memory_ratio = candidate[key]['peak_bytes'] / max(baseline[key]['peak_bytes'], 1)
+        flag = ''
+        if ratio >= args.threshold:
+            flag = '  REGRESSION'
+            regressions += 1
+        label = ' '.join(str(part) for part in key if part is not None)
+        print('{0:60} time x{1:6.2f}  peak mem x{2:6.2f}{3}'.format(label, ratio, memory_ratio, flag))
+
+    for key in sorted(set(baseline) ^ set(candidate), key=str):
+        print('{0:60} only in {1}'.format(' '.join(str(part) for part in key if part is not None),
+                                           'baseline' if key in baseline else 'candidate'))
+
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
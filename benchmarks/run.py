@@ -0,0 +1,162 @@
+import argparse
+import json
+import platform
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+from typing import Callable, Dict, List
+
+import numpy as np
+import PIL
+from PIL import Image
+
+from pyy_chr.core import BitplaneInterpreter, Buffer, BufferInterpreter, ColorGradient, TileMapper
+
+# (name, interleaved_row_count, layer_count)
+FORMATS = [
+    ('1bpp', 1, 1),
+    ('2bpp-planar', 1, 2),
+    ('2bpp-interleaved', 2, 1),
+    ('4bpp-planar', 1, 4),
+    ('4bpp-snes', 2, 2),
+    ('4bpp-interleaved', 4, 1),
+    ('8bpp-planar', 1, 8),
+    ('8bpp-snes', 2, 4),
+    ('8bpp-interleaved', 8, 1),
+]
+
+ROM_SIZES = [64 * 1024, 512 * 1024, 4 * 1024 * 1024]
+QUICK_ROM_SIZES = [64 * 1024]
+
+MAP_SIZES = [32, 64, 256]
+QUICK_MAP_SIZES = [32]
+
+
+def synthetic_rom(size: int, seed: int) -> bytearray:
+    return bytearray(random.Random(seed).randbytes(size))
+
+
+def measure(func: Callable[[], object], repeat: int) -> Dict[str, float]:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {'seconds': statistics.median(times), 'min_seconds': min(times), 'peak_bytes': peak}
+
+
+def bench_decode(rom_sizes: List[int], repeat: int, seed: int) -> List[dict]:
+    results = []
+    for size in rom_sizes:
+        data = synthetic_rom(size, seed)
+        for name, interleaved_row_count, layer_count in FORMATS:
+            buffer = Buffer(data)
+            result = measure(lambda: BitplaneInterpreter(buffer, interleaved_row_count, layer_count), repeat)
+            result.update(name='decode', format=name, rom_bytes=size,
+                          mb_per_s=size / (1024 * 1024) / result['seconds'])
+            results.append(result)
+    return results
+
+
+def bench_buffer_load(rom_sizes: List[int], repeat: int, seed: int) -> List[dict]:
+    results = []
+    for size in rom_sizes:
+        buffer = Buffer(synthetic_rom(size, seed))
+        result = measure(lambda: BufferInterpreter(256, 'P', buffer), repeat)
+        result.update(name='buffer_load', format='P', rom_bytes=size,
+                      mb_per_s=size / (1024 * 1024) / result['seconds'])
+        results.append(result)
+    return results
+
+
+def _tilemap(map_size: int, seed: int) -> TileMapper:
+    tiles = BitplaneInterpreter(Buffer(synthetic_rom(32 * 1024, seed)), 2, 2)
+    map_data = Buffer(synthetic_rom(map_size * map_size, seed + 1))
+    palette = ColorGradient('RGB', (0, 0, 0), (255, 255, 255), 16)
+    return TileMapper(BufferInterpreter(map_size, 'P', map_data), tiles, palette)
+
+
+def bench_tilemap(map_sizes: List[int], repeat: int, seed: int) -> List[dict]:
+    results = []
+    for map_size in map_sizes:
+        mapper = _tilemap(map_size, seed)
+        image = Image.new(mapper.color_format, mapper.size)
+
+        cold = measure(lambda: (mapper.tile_cache.clear(), mapper.generate_image(image)), repeat)
+        cold.update(name='tilemap_render_cold', map_cells=map_size * map_size, pixels=mapper.size[0] * mapper.size[1])
+        results.append(cold)
+
+        warm = measure(lambda: mapper.generate_image(image), repeat)
+        warm.update(name='tilemap_render_warm', map_cells=map_size * map_size, pixels=mapper.size[0] * mapper.size[1])
+        results.append(warm)
+    return results
+
+
+def bench_edit(rom_sizes: List[int], repeat: int, seed: int) -> List[dict]:
+    results = []
+    for size in rom_sizes:
+        buffer = Buffer(synthetic_rom(size, seed))
+        tiles = BitplaneInterpreter(buffer, 2, 2)
+        mapper = _tilemap(32, seed)
+        mapper.tile_source = tiles
+
+        rng = random.Random(seed)
+
+        def edit() -> None:
+            tiles.inject_point((rng.randrange(8), rng.randrange(8)), rng.randrange(16), rng.randrange(tiles.page_count))
+
+        result = measure(edit, repeat * 20)
+        result.update(name='edit_latency', format='4bpp-snes', rom_bytes=size)
+        results.append(result)
+    return results
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description='Benchmark the headless decode and render pipeline and write '
+                                                 'the results as JSON.')
+    parser.add_argument('-o', '--output', help='Write JSON here instead of stdout.')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='Timed runs per case; the median is reported.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--quick', action='store_true', help='Only run the smallest sizes.')
+    args = parser.parse_args(argv)
+
+    rom_sizes = QUICK_ROM_SIZES if args.quick else ROM_SIZES
+    map_sizes = QUICK_MAP_SIZES if args.quick else MAP_SIZES
+
+    results = []
+    for bench in (bench_decode, bench_buffer_load, bench_edit):
+        results.extend(bench(rom_sizes, args.repeat, args.seed))
+    results.extend(bench_tilemap(map_sizes, args.repeat, args.seed))
+
+    report = {
+        'meta': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'pillow': PIL.__version__,
+            'platform': platform.platform(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'repeat': args.repeat,
+            'seed': args.seed,
+        },
+        'results': results,
+    }
+
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write(text + '\n')
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
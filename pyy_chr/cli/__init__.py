@@ -0,0 +1,58 @@
+import os
+from typing import List, Tuple
+
+from PIL import Image
+
+# Bit-plane layouts as (interleaved_row_count, layer_count).
+FORMAT_PRESETS = {
+    '1bpp': (1, 1),
+    'nes': (1, 2),
+    'gb': (2, 1),
+    'snes-2bpp': (2, 1),
+    'snes-4bpp': (2, 2),
+    'snes-8bpp': (2, 4),
+}
+
+
+def parse_format(spec: str) -> Tuple[int, int]:
+    if spec in FORMAT_PRESETS:
+        return FORMAT_PRESETS[spec]
+
+    try:
+        interleaved_row_count, layer_count = (int(part) for part in spec.lower().split('x'))
+    except ValueError:
+        raise ValueError('Unknown format \'{0}\'. Use one of {1} or INTERLEAVExLAYERS, e.g. 2x2.'
+                         .format(spec, ', '.join(sorted(FORMAT_PRESETS)))) from None
+    if interleaved_row_count < 1 or layer_count < 1 or interleaved_row_count * layer_count > 8:
+        raise ValueError('Format \'{0}\' must have at least 1 row and 1 layer, and at most 8 bitplanes in total.'
+                         .format(spec))
+    return interleaved_row_count, layer_count
+
+
+def output_format_for(output_path: str) -> str:
+    return 'raw' if os.path.splitext(output_path)[1].lower() in ('.raw', '.bin') else 'png'
+
+
+def write_image(image: Image, output_path: str, output_format: str = None) -> None:
+    if output_format is None:
+        output_format = output_format_for(output_path)
+
+    if output_format == 'raw':
+        with open(output_path, 'wb') as output:
+            output.write(image.tobytes())
+    else:
+        image.save(output_path, format=output_format)
+
+
+def parse_palette(spec: str, bits_per_pixel: int) -> List[int]:
+    if spec is None or spec == 'gray':
+        levels = (1 << bits_per_pixel) - 1
+        return [round(255 * index / max(levels, 1)) for index in range(levels + 1) for _ in range(3)]
+
+    palette = []
+    for color in spec.split(','):
+        color = color.strip().lstrip('#')
+        if len(color) != 6:
+            raise ValueError('Palette colors must be six hex digits; got \'{0}\'.'.format(color))
+        palette.extend(int(color[offset:offset + 2], 16) for offset in (0, 2, 4))
+    return palette
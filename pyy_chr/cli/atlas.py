@@ -0,0 +1,59 @@
+import argparse
+import sys
+from typing import Sequence
+
+from pyy_chr.cli import parse_format, parse_palette, write_image
+from pyy_chr.core import BitplaneInterpreter, DecodeCache, MappedBuffer
+
+
+def export_atlas(rom_path: str, output_path: str, interleaved_row_count: int, layer_count: int, columns: int = 16,
+                 palette: Sequence[int] = None, output_format: str = None, decode_cache: DecodeCache = None) -> int:
+    with MappedBuffer(rom_path) as buffer:
+        interpreter = BitplaneInterpreter(buffer, interleaved_row_count, layer_count, lazy=True,
+                                          decode_cache=decode_cache)
+        atlas = interpreter.generate_atlas(columns, palette)
+        page_count = interpreter.page_count
+
+    write_image(atlas, output_path, output_format)
+    return page_count
+
+
+def main(argv: Sequence[str] = None) -> int:
+    parser = argparse.ArgumentParser(description='Render every tile in a ROM into a single tile-sheet image.')
+    parser.add_argument('rom', help='ROM or CHR dump to read.')
+    parser.add_argument('output', help='Output file; .raw/.bin writes one palette index per byte, '
+                                       'anything else is saved through Pillow.')
+    parser.add_argument('-f', '--format', default='nes',
+                        help='Bit-plane layout: a preset name or INTERLEAVExLAYERS. Default: nes.')
+    parser.add_argument('-c', '--columns', type=int, default=16, help='Tiles per atlas row. Default: 16.')
+    parser.add_argument('-p', '--palette', default='gray',
+                        help='Comma-separated RRGGBB colors, or \'gray\' for an even ramp. Default: gray.')
+    parser.add_argument('--output-format', choices=('png', 'raw'), default=None,
+                        help='Override the output format inferred from the file extension.')
+    parser.add_argument('--cache-dir', default=None,
+                        help='Directory for decoded tile data, reused when the same ROM is exported again.')
+    args = parser.parse_args(argv)
+
+    if args.columns < 1:
+        parser.error('--columns must be at least 1.')
+    try:
+        interleaved_row_count, layer_count = parse_format(args.format)
+        palette = parse_palette(args.palette, interleaved_row_count * layer_count)
+    except ValueError as e:
+        parser.error(str(e))
+
+    try:
+        decode_cache = DecodeCache(args.cache_dir) if args.cache_dir else None
+        page_count = export_atlas(args.rom, args.output, interleaved_row_count, layer_count, args.columns, palette,
+                                  args.output_format, decode_cache)
+    except (OSError, ValueError) as e:
+        # Unreadable, empty or missing files are user errors, not crashes.
+        message = str(e) if getattr(e, 'filename', None) else '{0}: {1}'.format(args.rom, e)
+        print('{0}: error: {1}'.format(parser.prog, message), file=sys.stderr)
+        return 1
+    print('{0}: {1} tiles -> {2}'.format(args.rom, page_count, args.output), file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
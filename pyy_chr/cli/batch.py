@@ -0,0 +1,327 @@
+import argparse
+import json
+import os
+import shlex
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Iterable, Iterator, List, NamedTuple, Optional, Sequence, TextIO
+
+from PIL import Image
+
+from pyy_chr.cli import output_format_for, parse_format, parse_palette, write_image
+from pyy_chr.core import BitplaneInterpreter, Buffer, BufferInterpreter, DecodeCache, GBA_TILE_ATTRIBUTES, \
+    MappedBuffer, SNES_TILE_ATTRIBUTES, TileMapper
+
+TILE_ATTRIBUTES = {
+    'none': None,
+    'snes': SNES_TILE_ATTRIBUTES,
+    'gba': GBA_TILE_ATTRIBUTES,
+}
+
+
+class BatchJob(NamedTuple):
+    rom_path: str
+    format: str
+    output_path: str
+    map_path: Optional[str] = None
+    map_width: int = 32
+    attributes: str = 'none'
+    entry_size: int = 1
+
+
+class BatchOptions(NamedTuple):
+    columns: int = 16
+    palette: str = 'gray'
+    output_format: Optional[str] = None
+    max_tiles: Optional[int] = None
+    cache_dir: Optional[str] = None
+
+
+class BatchResult(NamedTuple):
+    job: BatchJob
+    outputs: List[str]
+    tiles: int
+    bytes_read: int
+    seconds: float
+    error: Optional[str] = None
+
+
+def parse_job_line(line: str, default_format: str) -> Optional[dict]:
+    fields = shlex.split(line, comments=True)
+    if not fields:
+        return None
+
+    job = {'rom_path': fields[0], 'format': default_format}
+    for field in fields[1:]:
+        key, separator, value = field.partition('=')
+        if not separator:
+            job['format'] = field
+        elif key == 'map':
+            job['map_path'] = value
+        elif key in ('map-width', 'entry-size'):
+            job[key.replace('-', '_')] = int(value)
+        elif key == 'attributes':
+            job['attributes'] = value
+        else:
+            raise ValueError('Unknown job field \'{0}\' in line: {1}'.format(key, line.strip()))
+    return job
+
+
+def plan_jobs(specs: Iterable[dict], output_dir: str, output_format: str = None) -> List[BatchJob]:
+    extension = '.raw' if output_format == 'raw' else '.png'
+    jobs = []
+    used_paths = set()
+    for index, spec in enumerate(specs):
+        parse_format(spec['format'])
+        attributes = spec.get('attributes', 'none')
+        if attributes not in TILE_ATTRIBUTES:
+            raise ValueError('Unknown tile attributes \'{0}\'. Use one of {1}.'
+                             .format(attributes, ', '.join(sorted(TILE_ATTRIBUTES))))
+        # Attribute layouts pack flags above the tile index, so their entries default to 16 bits.
+        entry_size = spec.get('entry_size', 1 if attributes == 'none' else 2)
+        if entry_size not in (1, 2):
+            raise ValueError('Map entries must be 1 or 2 bytes wide.')
+
+        name = os.path.splitext(os.path.basename(spec['rom_path']))[0] + '.' + spec['format']
+        if spec.get('map_path'):
+            name += '.' + os.path.splitext(os.path.basename(spec['map_path']))[0]
+        # ROMs with the same name in different directories would otherwise overwrite each other.
+        if name in used_paths:
+            name += '-{0}'.format(index)
+        used_paths.add(name)
+
+        jobs.append(BatchJob(rom_path=spec['rom_path'], format=spec['format'],
+                             output_path=os.path.join(output_dir, name + extension),
+                             map_path=spec.get('map_path'), map_width=spec.get('map_width', 32),
+                             attributes=attributes, entry_size=entry_size))
+    return jobs
+
+
+def run_job(job: BatchJob, options: BatchOptions) -> BatchResult:
+    start = time.perf_counter()
+    try:
+        if job.map_path is None:
+            outputs, tiles, bytes_read = _render_sheets(job, options)
+        else:
+            outputs, tiles, bytes_read = _render_tilemap(job, options)
+    except Exception as e:
+        return BatchResult(job, [], 0, 0, time.perf_counter() - start, '{0}: {1}'.format(type(e).__name__, e))
+    return BatchResult(job, outputs, tiles, bytes_read, time.perf_counter() - start)
+
+
+def run_batch(jobs: Sequence[BatchJob], options: BatchOptions, workers: int = None,
+              max_tasks_per_child: int = None) -> Iterator[BatchResult]:
+    if workers == 1:
+        for job in jobs:
+            yield run_job(job, options)
+        return
+
+    workers = workers or os.cpu_count() or 1
+    pool_args = {'max_workers': workers}
+    if max_tasks_per_child is not None and sys.version_info >= (3, 11):
+        # Recycling workers returns whatever a large ROM left on the heap to the OS.
+        pool_args['max_tasks_per_child'] = max_tasks_per_child
+
+    with ProcessPoolExecutor(**pool_args) as executor:
+        # Only a couple of jobs per worker are queued at a time, so thousands of jobs don't pile up as futures.
+        pending = set()
+        job_iter = iter(jobs)
+        while True:
+            while len(pending) < workers * 2:
+                job = next(job_iter, None)
+                if job is None:
+                    break
+                pending.add(executor.submit(run_job, job, options))
+            if not pending:
+                break
+
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+
+def _decode_cache(options: BatchOptions) -> Optional[DecodeCache]:
+    return DecodeCache(options.cache_dir) if options.cache_dir else None
+
+
+def _sheet_path(output_path: str, index: int, sheet_count: int) -> str:
+    if sheet_count == 1:
+        return output_path
+    base, extension = os.path.splitext(output_path)
+    return '{0}.{1:03d}{2}'.format(base, index, extension)
+
+
+def _render_sheets(job: BatchJob, options: BatchOptions):
+    interleaved_row_count, layer_count = parse_format(job.format)
+    palette = parse_palette(options.palette, interleaved_row_count * layer_count)
+    output_format = options.output_format or output_format_for(job.output_path)
+
+    with MappedBuffer(job.rom_path) as buffer:
+        interpreter = BitplaneInterpreter(buffer, interleaved_row_count, layer_count, lazy=True,
+                                          decode_cache=_decode_cache(options))
+        page_count = interpreter.page_count
+        sheet_tiles = options.max_tiles or max(page_count, 1)
+        sheet_count = max(1, -(-page_count // sheet_tiles))
+
+        outputs = []
+        for index in range(sheet_count):
+            # Sheets are rendered and written one at a time; only one is ever held in memory.
+            atlas = interpreter.generate_atlas(options.columns, palette, index * sheet_tiles,
+                                               (index + 1) * sheet_tiles)
+            path = _sheet_path(job.output_path, index, sheet_count)
+            write_image(atlas, path, output_format)
+            outputs.append(path)
+        bytes_read = len(buffer)
+
+    return outputs, page_count, bytes_read
+
+
+def _render_tilemap(job: BatchJob, options: BatchOptions):
+    interleaved_row_count, layer_count = parse_format(job.format)
+    palette = parse_palette(options.palette, interleaved_row_count * layer_count)
+    attributes = TILE_ATTRIBUTES[job.attributes]
+
+    # Every palette select reads the same colors; the preview only needs the tiles to be distinguishable.
+    palette_columns = 1 if attributes is None else attributes.palette_mask + 1
+    colors = b''.join(bytes(palette[offset:offset + 3]) * palette_columns for offset in range(0, len(palette), 3))
+    palette_source = BufferInterpreter(palette_columns, 'RGB', Buffer(bytearray(colors)))
+
+    with MappedBuffer(job.rom_path) as tile_buffer, MappedBuffer(job.map_path) as map_buffer:
+        tile_source = BitplaneInterpreter(tile_buffer, interleaved_row_count, layer_count, lazy=True,
+                                          decode_cache=_decode_cache(options))
+        map_source = BufferInterpreter(job.map_width, 'L' if job.entry_size == 1 else 'LA', map_buffer)
+        mapper = TileMapper(map_source, tile_source, palette_source, attributes=attributes)
+
+        image = Image.new(mapper.color_format, mapper.size)
+        mapper.generate_image(image)
+        bytes_read = len(tile_buffer) + len(map_buffer)
+        tiles = map_source.size[0] * map_source.size[1]
+
+    write_image(image, job.output_path, options.output_format)
+    return [job.output_path], tiles, bytes_read
+
+
+def _print_progress(result: BatchResult, index: int, total: int, stream: TextIO) -> None:
+    if result.error is not None:
+        print('[{0}/{1}] {2} ({3}): FAILED {4}'.format(index, total, result.job.rom_path, result.job.format,
+                                                      result.error), file=stream)
+    else:
+        print('[{0}/{1}] {2} ({3}): {4} tiles -> {5} in {6:.0f} ms'.format(
+            index, total, result.job.rom_path, result.job.format, result.tiles, ', '.join(result.outputs),
+            result.seconds * 1000), file=stream)
+
+
+def _print_summary(results: Sequence[BatchResult], elapsed: float, stream: TextIO) -> None:
+    succeeded = [result for result in results if result.error is None]
+    tiles = sum(result.tiles for result in succeeded)
+    megabytes = sum(result.bytes_read for result in succeeded) / (1 << 20)
+    elapsed = max(elapsed, 1e-9)
+
+    print('{0} jobs ({1} failed) in {2:.2f} s: {3:.1f} jobs/s, {4:.0f} tiles/s, {5:.1f} MiB/s'.format(
+        len(results), len(results) - len(succeeded), elapsed, len(results) / elapsed, tiles / elapsed,
+        megabytes / elapsed), file=stream)
+
+
+def _manifest_record(result: BatchResult) -> dict:
+    return {
+        'rom': result.job.rom_path,
+        'format': result.job.format,
+        'map': result.job.map_path,
+        'outputs': result.outputs,
+        'tiles': result.tiles,
+        'bytes': result.bytes_read,
+        'seconds': round(result.seconds, 6),
+        'error': result.error,
+    }
+
+
+def _read_job_specs(args) -> List[dict]:
+    formats = args.format or ['nes']
+    specs = [{'rom_path': rom, 'format': spec} for rom in args.roms for spec in formats]
+    if args.jobs_file:
+        jobs_file = sys.stdin if args.jobs_file == '-' else open(args.jobs_file)
+        try:
+            for line in jobs_file:
+                spec = parse_job_line(line, formats[0])
+                if spec is not None:
+                    specs.append(spec)
+        finally:
+            if jobs_file is not sys.stdin:
+                jobs_file.close()
+    return specs
+
+
+def main(argv: Sequence[str] = None) -> int:
+    parser = argparse.ArgumentParser(
+        description='Render tile sheets or tilemaps for many ROMs in parallel.',
+        epilog='Jobs-file lines are "ROM [FORMAT] [map=PATH] [map-width=N] [attributes=none|snes|gba] '
+               '[entry-size=1|2]"; # starts a comment. A job with a map renders that tilemap instead of a '
+               'tile sheet.')
+    parser.add_argument('roms', nargs='*', help='ROM or CHR dumps to render as tile sheets.')
+    parser.add_argument('-o', '--output-dir', required=True, help='Directory the rendered images are written to.')
+    parser.add_argument('-f', '--format', action='append',
+                        help='Bit-plane layout: a preset name or INTERLEAVExLAYERS. Repeat to render every ROM '
+                             'in several layouts. Default: nes.')
+    parser.add_argument('-J', '--jobs-file', help='File listing one job per line, or - for stdin.')
+    parser.add_argument('-c', '--columns', type=int, default=16, help='Tiles per sheet row. Default: 16.')
+    parser.add_argument('-p', '--palette', default='gray',
+                        help='Comma-separated RRGGBB colors, or \'gray\' for an even ramp. Default: gray.')
+    parser.add_argument('--output-format', choices=('png', 'raw'), default=None,
+                        help='Output format. Default: png.')
+    parser.add_argument('--max-tiles', type=int, default=65536,
+                        help='Tiles per sheet; larger ROMs are split over several numbered sheets, which bounds '
+                             'the memory each worker needs. 0 disables splitting. Default: 65536.')
+    parser.add_argument('--cache-dir', default=None,
+                        help='Directory for decoded tile data, reused when the same ROM is rendered again.')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help='Worker processes. 1 renders in this process. Default: one per CPU.')
+    parser.add_argument('--max-tasks-per-child', type=int, default=64,
+                        help='Jobs a worker handles before it is replaced. Default: 64.')
+    parser.add_argument('--manifest', default=None,
+                        help='Append one JSON line per finished job to this file.')
+    parser.add_argument('-q', '--quiet', action='store_true', help='Only print the final summary.')
+    args = parser.parse_args(argv)
+
+    if args.workers is not None and args.workers < 1:
+        parser.error('--workers must be at least 1.')
+    if args.columns < 1:
+        parser.error('--columns must be at least 1.')
+    if args.max_tiles < 0:
+        parser.error('--max-tiles must not be negative.')
+
+    try:
+        for spec in args.format or []:
+            parse_format(spec)
+        parse_palette(args.palette, 1)
+        jobs = plan_jobs(_read_job_specs(args), args.output_dir, args.output_format)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+    if not jobs:
+        parser.error('No jobs given; pass ROM paths or --jobs-file.')
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    options = BatchOptions(columns=args.columns, palette=args.palette, output_format=args.output_format,
+                           max_tiles=args.max_tiles or None, cache_dir=args.cache_dir)
+
+    manifest = open(args.manifest, 'a') if args.manifest else None
+    results = []
+    start = time.perf_counter()
+    try:
+        for result in run_batch(jobs, options, args.workers, args.max_tasks_per_child):
+            results.append(result)
+            if manifest is not None:
+                manifest.write(json.dumps(_manifest_record(result)) + '\n')
+                manifest.flush()
+            if not args.quiet or result.error is not None:
+                _print_progress(result, len(results), len(jobs), sys.stderr)
+    finally:
+        if manifest is not None:
+            manifest.close()
+
+    _print_summary(results, time.perf_counter() - start, sys.stderr)
+    return 1 if any(result.error is not None for result in results) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,6 +1,11 @@
-from .buffer import Buffer
+from .instrumentation import TimingRecorder, TimingSummary, instrumentation
+from .buffer import Buffer, ByteRange, ranges_to_blocks
+from .mapped_buffer import MappedBuffer
+from .cache import CacheStats, LRUCache
+from .decode_cache import DecodeCache
+from .executor import get_default_executor, set_default_executor
 from .exception import PixelColorFormatException
 from .pixel_provider import *
 
 from .bitplane_interpreter import BitplaneInterpreter
-from .tile_mapper import TileMapper
+from .tile_mapper import GBA_TILE_ATTRIBUTES, SNES_TILE_ATTRIBUTES, TileAttributes, TileMapper
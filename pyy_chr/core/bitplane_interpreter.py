@@ -1,14 +1,58 @@
-from io import BytesIO
+import threading
+from collections import deque
+from concurrent.futures import Executor, Future, wait
+from typing import Callable, Iterable, List, Sequence
+
+import numpy as np
 from PIL import Image
 
-from pyy_chr.core import Buffer, Coordinate, PixelColor, PixelProvider, Size
+from pyy_chr.core import Box, Buffer, ByteRange, Coordinate, DecodeCache, LRUCache, PixelColor, PixelColorFormatException, \
+    PixelProvider, Size, WritablePixelProvider, get_default_executor, instrumentation, ranges_to_blocks
+
+
+def decode_bitplanes(data, interleaved_row_count: int, layer_count: int) -> np.ndarray:
+    bytes_per_page = 8 * interleaved_row_count * layer_count
+    page_count = len(data) // bytes_per_page
+
+    raw = np.frombuffer(data, dtype=np.uint8, count=page_count * bytes_per_page)
+    raw = raw.reshape(page_count, layer_count, 8, interleaved_row_count)
+
+    # (page, layer, row, interleave, x), with bit 7 of each byte landing on x == 0.
+    bits = np.unpackbits(raw[..., np.newaxis], axis=-1)
+
+    out = np.zeros((page_count, 8, 8), dtype=np.uint8)
+    bitplane = 0
+    for layer in range(layer_count):
+        for interleave in range(interleaved_row_count):
+            out |= bits[:, layer, :, interleave, :] << bitplane
+            bitplane += 1
+
+    return out
+
 
+def encode_bitplanes(pixels: np.ndarray, interleaved_row_count: int, layer_count: int) -> bytes:
+    pixels = np.asarray(pixels, dtype=np.uint8).reshape(-1, 8, 8)
+    plane_count = interleaved_row_count * layer_count
 
-class BitplaneInterpreter(PixelProvider):
-    def __init__(self, buffer: Buffer, interleaved_row_count: int, layer_count: int):
+    # (page, bitplane, row, x) -> one byte per (page, bitplane, row), x == 0 in bit 7.
+    bits = (pixels[:, np.newaxis, :, :] >> np.arange(plane_count, dtype=np.uint8)[:, np.newaxis, np.newaxis]) & 1
+    planes = np.packbits(bits, axis=-1)[..., 0]
+
+    # Bitplane index is layer * interleaved_row_count + interleave; rows are interleaved within each layer.
+    planes = planes.reshape(len(pixels), layer_count, interleaved_row_count, 8).transpose(0, 1, 3, 2)
+    return planes.tobytes()
+
+
+class BitplaneInterpreter(PixelProvider, WritablePixelProvider):
+    # Pages decoded per background task when the initial decode runs on an executor.
+    ASYNC_CHUNK_PAGES = 512
+
+    def __init__(self, buffer: Buffer, interleaved_row_count: int, layer_count: int, lazy: bool = False,
+                 page_cache_capacity: int = 1024, executor: Executor = None, decode_cache: DecodeCache = None,
+                 dispatcher: Callable[[Callable[[], None]], None] = None):
         super().__init__()
 
-        if interleaved_row_count + layer_count > 8:
+        if interleaved_row_count * layer_count > 8:
             raise Exception('No more than 8 bits total are supported! interleaved={0}, layers={1}'
                             .format(interleaved_row_count, layer_count))
 
@@ -19,9 +63,32 @@ class BitplaneInterpreter(PixelProvider):
         self._bytes_per_layer = 8 * self._interleaved_row_count
         self._bytes_per_page = self._bytes_per_layer * self._layer_count
 
-        self._image = None
+        self._lazy = lazy
+        self._pixels = None
+        self._page_cache = LRUCache(page_cache_capacity, name='bitplane.pages') if lazy else None
+
+        self._executor = executor
+        self._pending_chunks = []
+        self._decode_cache = decode_cache
+        self._content_digest = None
+        self._buffer_generation = 0
+
+        # Chunks decoded on the executor are announced from the owner's thread, never from a pool worker.
+        # dispatch_decoded() delivers them; a dispatcher (e.g. one scheduling on a UI loop) is handed that
+        # method from the worker each time a chunk lands.
+        self._dispatcher = dispatcher
+        self._decoded_chunks = deque()
+        self._chunk_lock = threading.Lock()
+        self._chunks_remaining = 0
+        self._async_store = None
+
+        if not self._lazy:
+            if self._executor is None:
+                self._process_buffer()
+            else:
+                self._process_buffer_async()
 
-        self._process_buffer()
+        self._buffer.events.on_changed += self._on_buffer_changed
 
     @property
     def size(self) -> Size:
@@ -35,34 +102,265 @@ class BitplaneInterpreter(PixelProvider):
     def page_count(self) -> int:
         return len(self._buffer) // self._bytes_per_page
 
+    @property
+    def lazy(self) -> bool:
+        return self._lazy
+
+    @property
+    def page_cache(self) -> LRUCache:
+        return self._page_cache
+
+    @property
+    def decode_cache(self) -> DecodeCache:
+        return self._decode_cache
+
     def generate_image(self, image: Image, page: int = 0) -> None:
-        image.paste(self._image.crop((0, page * self.size[1], self.size[0], page * self.size[1] + self.size[1])))
+        with instrumentation.timed('bitplane.generate_image', page=page):
+            image.paste(Image.frombytes(self.color_format, self.size, self._get_page(page).tobytes()))
+
+    def generate_region(self, image: Image, box: Box, page: int = 0) -> None:
+        pixels = np.ascontiguousarray(self._get_page(page)[box[1]:box[3], box[0]:box[2]])
+        image.paste(Image.frombytes(self.color_format, (box[2] - box[0], box[3] - box[1]), pixels.tobytes()), box[:2])
 
     def generate_point(self, point: Coordinate, page: int = 0) -> PixelColor:
-        return self._image.getpixel((point[0], point[1] + page * self.size[1]))
+        return int(self._get_page(page)[point[1], point[0]])
 
-    def _process_buffer(self):
-        in_data = BytesIO(self._buffer.data)
-        out_data = BytesIO()
+    def generate_points(self, points, page: int = 0) -> np.ndarray:
+        xs, ys = self._split_points(points)
+        return self._get_page(page)[ys, xs][:, np.newaxis]
+
+    def read_region(self, box: Box, page: int = 0) -> np.ndarray:
+        self._verify_box(box)
+        pixels = self._get_page(page)[box[1]:box[3], box[0]:box[2], np.newaxis]
+        pixels.flags.writeable = False
+        return pixels
+
+    @property
+    def decoded(self) -> bool:
+        return all(future.done() for _, _, future in self._pending_chunks)
 
+    def wait_decoded(self, timeout: float = None) -> bool:
+        pending = [future for _, _, future in self._pending_chunks]
+        _, not_done = wait(pending, timeout)
+        for future in pending:
+            if future.done():
+                future.result()
+        self.dispatch_decoded()
+        return not not_done
+
+    def dispatch_decoded(self) -> bool:
+        pages = []
         while True:
-            page_data = in_data.read(self._bytes_per_page)
-            if len(page_data) < self._bytes_per_page:
+            try:
+                first_page, last_page = self._decoded_chunks.popleft()
+            except IndexError:
                 break
+            pages.extend(range(first_page, last_page))
+
+        if pages:
+            self._invalidate(pages=pages)
+        return bool(pages)
+
+    def prefetch_pages(self, pages: Iterable[int], executor: Executor = None) -> List[Future]:
+        executor = executor or self._executor or get_default_executor()
+        return [executor.submit(self._get_page, page) for page in pages]
+
+    def inject_point(self, point: Coordinate, value: PixelColor, page: int = 0) -> None:
+        width, height = self.size
+        if not (0 <= point[0] < width and 0 <= point[1] < height):
+            raise IndexError('Point {0} is out of range for page size {1}.'.format(tuple(point), self.size))
+        index = self._verify_index(value if isinstance(value, int) else value[0])
+
+        if not 0 <= page < self.page_count:
+            raise IndexError('Page {0} is out of range for {1} pages.'.format(page, self.page_count))
+
+        # Patch the pixel's bit in each plane; reading through the buffer keeps this correct inside a batch.
+        page_start = page * self._bytes_per_page
+        data = bytearray(self._buffer.read(page_start, page_start + self._bytes_per_page))
+        mask = 0x80 >> point[0]
+        for bitplane in range(self._interleaved_row_count * self._layer_count):
+            layer, interleave = divmod(bitplane, self._interleaved_row_count)
+            offset = layer * self._bytes_per_layer + point[1] * self._interleaved_row_count + interleave
+            if (index >> bitplane) & 1:
+                data[offset] |= mask
+            else:
+                data[offset] &= ~mask & 0xff
+        self._buffer.write(page_start, data)
+
+    def inject_image(self, image: Image, page: int = 0) -> None:
+        if image.mode not in ('P', 'L'):
+            raise PixelColorFormatException('Bit-plane data can only be imported from P or L images; got {0}.'
+                                            .format(image.mode))
+
+        tile_width, tile_height = self.size
+        if image.size[0] % tile_width != 0 or image.size[1] % tile_height != 0:
+            raise ValueError('Image size {0} is not a whole number of {1}x{2} tiles.'
+                             .format(image.size, tile_width, tile_height))
+
+        columns, rows = image.size[0] // tile_width, image.size[1] // tile_height
+        if page < 0 or page + columns * rows > self.page_count:
+            raise IndexError('Pages {0}-{1} are out of range for {2} pages.'
+                             .format(page, page + columns * rows, self.page_count))
+
+        # Tiles are taken in row-major order, the inverse of generate_atlas.
+        pixels = np.asarray(image).reshape(rows, tile_height, columns, tile_width).transpose(0, 2, 1, 3)
+        self._verify_index(int(pixels.max()))
+
+        with self._buffer.batch() as writer:
+            writer.write(page * self._bytes_per_page,
+                         encode_bitplanes(pixels, self._interleaved_row_count, self._layer_count))
+
+    def generate_atlas(self, columns: int = 16, palette: Sequence[int] = None, first_page: int = 0,
+                       last_page: int = None) -> Image:
+        if columns < 1:
+            raise ValueError('An atlas needs at least one column; got {0}.'.format(columns))
+        pixels = self._page_range(first_page, self.page_count if last_page is None else last_page)
+        tile_width, tile_height = self.size
+        rows = -(-len(pixels) // columns)
+
+        sheet = np.zeros((rows * columns, tile_height, tile_width), dtype=np.uint8)
+        sheet[:len(pixels)] = pixels
+        # (row, col, y, x) -> (row, y, col, x), the same layout trick TileMapper uses for frames.
+        sheet = sheet.reshape(rows, columns, tile_height, tile_width).transpose(0, 2, 1, 3)
+
+        atlas = Image.frombytes(self.color_format, (columns * tile_width, rows * tile_height), sheet.tobytes())
+        if palette is not None:
+            atlas.putpalette(palette)
+        return atlas
+
+    def invalidate_pages(self, pages: Iterable[int] = None) -> None:
+        if pages is None:
+            if self._lazy:
+                self._page_cache.clear()
+            else:
+                self._wait_for_pages(0, self.page_count)
+                self._process_buffer()
+        else:
+            pages = sorted(set(pages))
+            for page in pages:
+                if self._lazy:
+                    self._page_cache.invalidate(page)
+                else:
+                    self._wait_for_pages(page, page + 1)
+                    self._process_pages(page, page + 1)
+        self._invalidate(pages=pages)
+
+    def _get_page(self, page: int) -> np.ndarray:
+        if not 0 <= page < self.page_count:
+            raise IndexError('Page {0} is out of range for {1} pages.'.format(page, self.page_count))
+
+        if not self._lazy:
+            if self._pending_chunks:
+                self._wait_for_pages(page, page + 1)
+            return self._pixels[page]
+
+        return self._page_cache.get_or_create(page, lambda: self._decode_page(page))
+
+    def _verify_index(self, index: int) -> int:
+        color_count = 1 << (self._interleaved_row_count * self._layer_count)
+        if not 0 <= index < color_count:
+            raise ValueError('Color index {0} does not fit in {1} colors.'.format(index, color_count))
+        return index
+
+    def _page_range(self, first_page: int, last_page: int) -> np.ndarray:
+        first_page, last_page, _ = slice(first_page, last_page).indices(self.page_count)
+        last_page = max(first_page, last_page)
+        if self._lazy:
+            # Only the requested pages are decoded, so large ROMs can be exported in bounded slices.
+            return self._decode_range(first_page, last_page)
+
+        self._wait_for_pages(first_page, last_page)
+        return self._pixels[first_page:last_page]
+
+    def _decode_page(self, page: int) -> np.ndarray:
+        data = self._buffer.view(page * self._bytes_per_page, (page + 1) * self._bytes_per_page)
+        return self._decode_view(data)[0]
+
+    def _decode_range(self, first_page: int, last_page: int) -> np.ndarray:
+        data = self._buffer.view(first_page * self._bytes_per_page, last_page * self._bytes_per_page)
+        if self._decode_cache is None:
+            return self._decode_view(data)
+        # Keyed by content hash, so edited buffers simply miss and the entry for the old contents stays valid.
+        return self._decode_cache.get_or_decode(self._cache_key(first_page, last_page),
+                                                lambda: self._decode_view(data))
+
+    def _decode_view(self, data) -> np.ndarray:
+        with instrumentation.timed('bitplane.decode', pages=len(data) // self._bytes_per_page):
+            return decode_bitplanes(data, self._interleaved_row_count, self._layer_count)
+
+    def _cache_key(self, first_page: int, last_page: int) -> str:
+        # The buffer is hashed once and the digest reused for every range until the buffer changes.
+        if self._content_digest is None:
+            self._content_digest = DecodeCache.digest(self._buffer.view())
+        return DecodeCache.key(self._content_digest, self._interleaved_row_count, self._layer_count,
+                               first_page, last_page)
+
+    def _process_buffer(self):
+        self._pixels = self._decode_range(0, self.page_count)
+
+    def _process_buffer_async(self) -> None:
+        if self._decode_cache is not None:
+            key = self._cache_key(0, self.page_count)
+            self._pixels = self._decode_cache.load(key)
+            if self._pixels is not None:
+                return
+            self._async_store = (key, self._buffer_generation)
+
+        page_count = self.page_count
+        self._pixels = np.zeros((page_count, 8, 8), dtype=np.uint8)
+        self._chunks_remaining = -(-page_count // self.ASYNC_CHUNK_PAGES)
+        self._pending_chunks = [
+            (first_page, min(first_page + self.ASYNC_CHUNK_PAGES, page_count),
+             self._executor.submit(self._process_chunk, first_page, min(first_page + self.ASYNC_CHUNK_PAGES, page_count)))
+            for first_page in range(0, page_count, self.ASYNC_CHUNK_PAGES)]
+
+    def _process_chunk(self, first_page: int, last_page: int) -> None:
+        self._process_pages(first_page, last_page)
+        with self._chunk_lock:
+            self._chunks_remaining -= 1
+            finished = self._chunks_remaining == 0
+        if finished and self._async_store is not None:
+            self._store_decoded()
+
+        self._decoded_chunks.append((first_page, last_page))
+        if self._dispatcher is not None:
+            self._dispatcher(self.dispatch_decoded)
+
+    def _store_decoded(self) -> None:
+        key, generation = self._async_store
+        self._async_store = None
 
-            for y in range(8):
-                for x in range(8):
-                    bitplane = 0
-                    val = 0
+        # Chunks decoded after an edit mix old and new contents, so they no longer match the key taken at start.
+        if generation != self._buffer_generation:
+            return
+        self._decode_cache.store(key, self._pixels)
+        # An edit landing while the file was written may have patched pages mid-save.
+        if generation != self._buffer_generation:
+            self._decode_cache.invalidate(key)
 
-                    for layer in range(self._layer_count):
-                        layer_start = layer * self._interleaved_row_count * 8
-                        for interleave in range(self._interleaved_row_count):
-                            bit = (page_data[layer_start + y * self._interleaved_row_count + interleave] >> (7 - x)) & 1
-                            val |= bit << bitplane
-                            bitplane += 1
+    def _wait_for_pages(self, first_page: int, last_page: int) -> None:
+        for chunk_first, chunk_last, future in self._pending_chunks:
+            if chunk_first < last_page and first_page < chunk_last:
+                future.result()
+        self._pending_chunks = [chunk for chunk in self._pending_chunks if not chunk[2].done()]
 
-                    out_data.write(val.to_bytes(1, byteorder='big'))
+    def _process_pages(self, first_page: int, last_page: int) -> None:
+        data = self._buffer.view(first_page * self._bytes_per_page, last_page * self._bytes_per_page)
+        with instrumentation.timed('bitplane.decode', pages=last_page - first_page):
+            self._pixels[first_page:last_page] = decode_bitplanes(data, self._interleaved_row_count,
+                                                                  self._layer_count)
 
-        self._image = Image.frombytes(self.color_format, (self.size[0], self.size[1] * self.page_count),
-                                      out_data.getvalue())
+    def _on_buffer_changed(self, changed_ranges: Sequence[ByteRange]) -> None:
+        self._content_digest = None
+        self._buffer_generation += 1
+        pages = []
+        for first_page, last_page in ranges_to_blocks(changed_ranges, self._bytes_per_page, self.page_count):
+            if self._lazy:
+                for page in range(first_page, last_page):
+                    self._page_cache.invalidate(page)
+            else:
+                self._wait_for_pages(first_page, last_page)
+                self._process_pages(first_page, last_page)
+            pages.extend(range(first_page, last_page))
+        if pages:
+            self._invalidate(pages=pages)
@@ -1,5 +1,28 @@
+from bisect import bisect_left, bisect_right
+from collections import deque
+from contextlib import contextmanager
 from events import Events
-from typing import Callable, Sequence
+from typing import Callable, Iterable, Iterator, List, Sequence, Tuple
+
+from pyy_chr.core.instrumentation import instrumentation
+
+ByteRange = Tuple[int, int]
+
+
+def ranges_to_blocks(ranges: Iterable[ByteRange], block_size: int, block_count: int) -> List[Tuple[int, int]]:
+    blocks = []
+    for start, end in sorted(ranges):
+        if end <= start:
+            continue
+        first = start // block_size
+        last = min((end - 1) // block_size + 1, block_count)
+        if first >= last:
+            continue
+        if blocks and first <= blocks[-1][1]:
+            blocks[-1] = (blocks[-1][0], max(blocks[-1][1], last))
+        else:
+            blocks.append((first, last))
+    return blocks
 
 
 class Buffer:
@@ -8,26 +31,101 @@ class Buffer:
             self._on_done = on_done
             self._max_length = max_length
 
-            self._writes = []
+            # Pending writes are kept as sorted, non-overlapping, non-adjacent spans; _starts mirrors their
+            # start positions for bisection.
+            self._starts = []
+            self._spans = []
+
+        def __enter__(self) -> 'Buffer.BufferWriter':
+            return self
+
+        def __exit__(self, exc_type, *_) -> None:
+            if exc_type is None:
+                self.end_write()
+            else:
+                self.discard()
+
+        @property
+        def spans(self) -> List[ByteRange]:
+            return [(start, start + len(span)) for start, span in zip(self._starts, self._spans)]
 
         def write(self, start_pos: int, data: Sequence[int]) -> 'Buffer.BufferWriter':
-            if start_pos < 0 or start_pos + len(data) > self._max_length:
+            if self._spans is None:
+                raise Exception('Write already finished!')
+
+            end_pos = start_pos + len(data)
+            if start_pos < 0 or end_pos > self._max_length:
                 raise IndexError('Data range {0}-{1} is out of range for a buffer of length {2}.'.format(
-                    start_pos, start_pos + len(data), self._max_length))
+                    start_pos, end_pos, self._max_length))
+            if start_pos == end_pos:
+                return self
+
+            # Spans [first, last) overlap or touch the new data.
+            first = bisect_left(self._starts, start_pos)
+            if first > 0 and self._starts[first - 1] + len(self._spans[first - 1]) >= start_pos:
+                first -= 1
+            last = bisect_right(self._starts, end_pos)
+
+            if first == last:
+                self._starts.insert(first, start_pos)
+                self._spans.insert(first, bytearray(data))
+            elif last - first == 1 and self._starts[first] <= start_pos:
+                # Common case of pokes into or just past one span: patch it in place.
+                span = self._spans[first]
+                offset = start_pos - self._starts[first]
+                span[offset:offset + len(data)] = data
+            else:
+                merged_start = min(start_pos, self._starts[first])
+                merged_end = max(end_pos, self._starts[last - 1] + len(self._spans[last - 1]))
+
+                merged = bytearray(merged_end - merged_start)
+                for span_start, span in zip(self._starts[first:last], self._spans[first:last]):
+                    merged[span_start - merged_start:span_start - merged_start + len(span)] = span
+                merged[start_pos - merged_start:end_pos - merged_start] = data
+
+                self._starts[first:last] = [merged_start]
+                self._spans[first:last] = [merged]
 
-            self._writes.append((start_pos, bytes(data)))
             return self
 
+        def overlay(self, start_pos: int, data: Sequence[int]) -> bytes:
+            result = bytearray(data)
+            end_pos = start_pos + len(result)
+
+            first = max(bisect_right(self._starts, start_pos) - 1, 0)
+            for span_start, span in zip(self._starts[first:], self._spans[first:]):
+                if span_start >= end_pos:
+                    break
+                lo, hi = max(span_start, start_pos), min(span_start + len(span), end_pos)
+                if lo < hi:
+                    result[lo - start_pos:hi - start_pos] = span[lo - span_start:hi - span_start]
+            return bytes(result)
+
         def end_write(self) -> None:
-            self._on_done(self._writes)
+            self._on_done(list(zip(self._starts, self._spans)))
 
-            self._writes = None
+            self._starts = None
+            self._spans = None
             self._on_done = None
 
-    def __init__(self, data: Sequence[int]) -> None:
+        def discard(self) -> None:
+            self._starts = []
+            self._spans = []
+            self.end_write()
+
+    # Bytes of prior contents kept for undo; the oldest steps are dropped first once this is exceeded.
+    DEFAULT_HISTORY_LIMIT = 4 * 1024 * 1024
+
+    def __init__(self, data: Sequence[int], history_limit: int = DEFAULT_HISTORY_LIMIT) -> None:
         self._data = data
 
         self._current_writer = None
+        self._batch_depth = 0
+
+        self._history_limit = history_limit
+        self._undo_steps = deque()
+        self._redo_steps = []
+        self._history_bytes = 0
 
         self.events = Events(['on_changed'])
 
@@ -41,15 +139,132 @@ class Buffer:
     def data(self):
         return self._data
 
+    def view(self, start: int = 0, end: int = None) -> memoryview:
+        try:
+            return memoryview(self._data)[start:end]
+        except TypeError:
+            return memoryview(bytes(self._data[start:end]))
+
+    @property
+    def history_limit(self) -> int:
+        return self._history_limit
+
+    @history_limit.setter
+    def history_limit(self, history_limit: int) -> None:
+        self._history_limit = history_limit
+        self._trim_history()
+
+    @property
+    def history_bytes(self) -> int:
+        return self._history_bytes
+
+    @property
+    def can_undo(self) -> bool:
+        return len(self._undo_steps) > 0
+
+    @property
+    def can_redo(self) -> bool:
+        return len(self._redo_steps) > 0
+
+    def undo(self) -> bool:
+        if self._current_writer is not None:
+            raise Exception('Write already in progress!')
+        if not self._undo_steps:
+            return False
+
+        step = self._undo_steps.pop()
+        self._history_bytes -= self._step_size(step)
+        self._redo_steps.append(self._apply_step(step))
+        return True
+
+    def redo(self) -> bool:
+        if self._current_writer is not None:
+            raise Exception('Write already in progress!')
+        if not self._redo_steps:
+            return False
+
+        self._push_undo(self._apply_step(self._redo_steps.pop()))
+        return True
+
+    def clear_history(self) -> None:
+        self._undo_steps.clear()
+        self._redo_steps.clear()
+        self._history_bytes = 0
+
+    def read(self, start_pos: int, end_pos: int) -> bytes:
+        data = bytes(self._data[start_pos:end_pos])
+        # Inside a batch, reads see the writes that have not been applied yet.
+        return data if self._current_writer is None else self._current_writer.overlay(start_pos, data)
+
     def begin_write(self) -> BufferWriter:
         if self._current_writer is not None:
             raise Exception('Write already in progress!')
-        return Buffer.BufferWriter(self._on_write_done, len(self._data))
+        self._current_writer = Buffer.BufferWriter(self._on_write_done, len(self._data))
+        return self._current_writer
+
+    @contextmanager
+    def batch(self) -> Iterator[BufferWriter]:
+        if self._batch_depth > 0:
+            self._batch_depth += 1
+            try:
+                yield self._current_writer
+            finally:
+                self._batch_depth -= 1
+            return
+
+        writer = self.begin_write()
+        self._batch_depth = 1
+        try:
+            yield writer
+        except BaseException:
+            self._batch_depth = 0
+            writer.discard()
+            raise
+        self._batch_depth = 0
+        writer.end_write()
 
     def write(self, start_pos: int, data: Sequence[int]) -> None:
-        self.begin_write().write(start_pos, data).end_write()
+        if self._batch_depth > 0:
+            self._current_writer.write(start_pos, data)
+        else:
+            self.begin_write().write(start_pos, data).end_write()
 
     def _on_write_done(self, writes) -> None:
-        for write_item in writes:
-            self._data[write_item[0]:write_item[0] + len(write_item[1])] = write_item[1]
-        self.events.on_changed()
+        self._current_writer = None
+
+        if writes:
+            self._redo_steps.clear()
+            self._push_undo(self._apply_step(writes))
+
+    def _apply_step(self, writes) -> List[Tuple[int, bytes]]:
+        prior = []
+        changed_ranges = []
+        with instrumentation.timed('buffer.write', spans=len(writes)):
+            for start_pos, data in writes:
+                end_pos = start_pos + len(data)
+                if self._history_limit > 0:
+                    prior.append((start_pos, bytes(self._data[start_pos:end_pos])))
+                self._data[start_pos:end_pos] = data
+                changed_ranges.append((start_pos, end_pos))
+        if instrumentation.enabled:
+            instrumentation.count('buffer.bytes_written', sum(end - start for start, end in changed_ranges))
+
+        self.events.on_changed(changed_ranges)
+        return prior
+
+    def _push_undo(self, step: List[Tuple[int, bytes]]) -> None:
+        if not step:
+            return
+        self._undo_steps.append(step)
+        self._history_bytes += self._step_size(step)
+        self._trim_history()
+
+    def _trim_history(self) -> None:
+        while self._undo_steps and self._history_bytes > self._history_limit:
+            self._history_bytes -= self._step_size(self._undo_steps.popleft())
+        if self._history_limit <= 0:
+            self._redo_steps.clear()
+
+    @staticmethod
+    def _step_size(step: List[Tuple[int, bytes]]) -> int:
+        return sum(len(data) for _, data in step)
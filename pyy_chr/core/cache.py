@@ -0,0 +1,200 @@
+import sys
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, NamedTuple
+
+from pyy_chr.core.instrumentation import instrumentation
+
+
+class CacheStats(NamedTuple):
+    entries: int
+    bytes: int
+    hits: int
+    misses: int
+    evictions: int
+    decode_time: float
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return 0.0 if lookups == 0 else self.hits / lookups
+
+
+def _default_sizeof(value: Any) -> int:
+    return getattr(value, 'nbytes', None) or sys.getsizeof(value)
+
+
+class LRUCache:
+    def __init__(self, capacity: int = None, max_bytes: int = None, sizeof: Callable[[Any], int] = None,
+                 name: str = 'cache') -> None:
+        self._check_bound('capacity', capacity)
+        self._check_bound('max_bytes', max_bytes)
+
+        self._name = name
+        self._hit_counter = name + '.hit'
+        self._miss_counter = name + '.miss'
+        self._capacity = capacity
+        self._max_bytes = max_bytes
+        self._sizeof = _default_sizeof if sizeof is None else sizeof
+
+        # Caches are shared with background render threads; the lock is not held while a factory runs.
+        self._lock = threading.RLock()
+        self._entries = OrderedDict()
+        self._sizes = {}
+        self._bytes = 0
+        # Bumped by invalidate() and clear(), so a factory that was running across one doesn't store a stale value.
+        self._generation = 0
+
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._decode_time = 0.0
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    @property
+    def capacity(self) -> int:
+        return self._capacity
+
+    @capacity.setter
+    def capacity(self, capacity: int) -> None:
+        self._check_bound('capacity', capacity)
+        with self._lock:
+            self._capacity = capacity
+            self._evict()
+
+    @property
+    def max_bytes(self) -> int:
+        return self._max_bytes
+
+    @max_bytes.setter
+    def max_bytes(self, max_bytes: int) -> None:
+        self._check_bound('max_bytes', max_bytes)
+        with self._lock:
+            self._max_bytes = max_bytes
+            self._evict()
+
+    @property
+    def bytes(self) -> int:
+        return self._bytes
+
+    @property
+    def hits(self) -> int:
+        return self._hits
+
+    @property
+    def misses(self) -> int:
+        return self._misses
+
+    @property
+    def evictions(self) -> int:
+        return self._evictions
+
+    @property
+    def decode_time(self) -> float:
+        return self._decode_time
+
+    @property
+    def stats(self) -> CacheStats:
+        return CacheStats(len(self._entries), self._bytes, self._hits, self._misses, self._evictions,
+                          self._decode_time)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            hit = key in self._entries
+            if hit:
+                self._hits += 1
+                self._entries.move_to_end(key)
+                value = self._entries[key]
+            else:
+                self._misses += 1
+                value = default
+
+        # Listeners are user code, so they are only ever called once the lock is released.
+        if instrumentation.enabled:
+            instrumentation.count(self._hit_counter if hit else self._miss_counter)
+        return value
+
+    def get_or_create(self, key: Hashable, factory: Callable[[], Any]) -> Any:
+        with self._lock:
+            hit = key in self._entries
+            if hit:
+                self._hits += 1
+                self._entries.move_to_end(key)
+                value = self._entries[key]
+            else:
+                self._misses += 1
+            generation = self._generation
+
+        if instrumentation.enabled:
+            instrumentation.count(self._hit_counter if hit else self._miss_counter)
+        if hit:
+            return value
+
+        start = time.perf_counter()
+        value = factory()
+        elapsed = time.perf_counter() - start
+
+        with self._lock:
+            self._decode_time += elapsed
+            if generation == self._generation:
+                self.put(key, value)
+        return value
+
+    def put(self, key: Hashable, value: Any) -> None:
+        size = self._sizeof(value)
+        with self._lock:
+            self._discard(key)
+
+            self._entries[key] = value
+            self._sizes[key] = size
+            self._bytes += size
+
+            self._evict()
+
+    def invalidate(self, key: Hashable) -> bool:
+        with self._lock:
+            self._generation += 1
+            return self._discard(key)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self._sizes.clear()
+            self._bytes = 0
+
+    def reset_stats(self) -> None:
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._decode_time = 0.0
+
+    def _discard(self, key: Hashable) -> bool:
+        if key not in self._entries:
+            return False
+        del self._entries[key]
+        self._bytes -= self._sizes.pop(key)
+        return True
+
+    def _evict(self) -> None:
+        # The most recently used entry is always kept, even if it alone exceeds the byte budget.
+        while len(self._entries) > 1 and \
+                ((self._capacity is not None and len(self._entries) > self._capacity) or
+                 (self._max_bytes is not None and self._bytes > self._max_bytes)):
+            self._discard(next(iter(self._entries)))
+            self._evictions += 1
+
+    @staticmethod
+    def _check_bound(name: str, value: int) -> None:
+        if value is not None and value < 1:
+            raise ValueError('Cache {0} must be at least 1; got {1}.'.format(name, value))
@@ -0,0 +1,129 @@
+import hashlib
+import os
+import uuid
+from typing import Callable, Optional
+
+import numpy as np
+
+
+class DecodeCache:
+    # Bumped whenever the decoded layout changes, so stale entries from older versions are never loaded.
+    FORMAT_VERSION = 1
+
+    def __init__(self, directory: str, max_bytes: int = None) -> None:
+        if max_bytes is not None and max_bytes < 0:
+            raise ValueError('max_bytes must be non-negative, got {0}'.format(max_bytes))
+
+        self._directory = directory
+        self._max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    @property
+    def directory(self) -> str:
+        return self._directory
+
+    @property
+    def max_bytes(self) -> int:
+        return self._max_bytes
+
+    @property
+    def bytes(self) -> int:
+        return sum(size for _, _, size in self._entries())
+
+    @staticmethod
+    def digest(data) -> str:
+        return hashlib.blake2b(data, digest_size=20).hexdigest()
+
+    @classmethod
+    def key(cls, digest: str, interleaved_row_count: int, layer_count: int, first_page: int, last_page: int) -> str:
+        return '{0}-{1}x{2}-{3}-{4}-v{5}'.format(digest, interleaved_row_count, layer_count, first_page, last_page,
+                                                 cls.FORMAT_VERSION)
+
+    def load(self, key: str) -> Optional[np.ndarray]:
+        path = self._path(key)
+        try:
+            # Copy-on-write mapping: callers may patch pages in place without touching the file on disk.
+            pixels = np.load(path, mmap_mode='c')
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError):
+            self.invalidate(key)
+            return None
+
+        if pixels.dtype != np.uint8 or pixels.ndim != 3 or pixels.shape[1:] != (8, 8):
+            self.invalidate(key)
+            return None
+
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return pixels
+
+    def store(self, key: str, pixels: np.ndarray) -> None:
+        # Written under a temporary name and renamed into place, so concurrent readers never see a partial file.
+        # Opened with 0666 rather than through mkstemp (0600), so the umask decides who can read shared caches.
+        temp_path = os.path.join(self._directory, '{0}.{1}.tmp'.format(key, uuid.uuid4().hex))
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0o666)
+        try:
+            with os.fdopen(fd, 'wb') as output:
+                np.save(output, np.ascontiguousarray(pixels, dtype=np.uint8))
+            os.replace(temp_path, self._path(key))
+        except BaseException:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            raise
+
+        if self._max_bytes is not None:
+            self._trim(keep=key)
+
+    def get_or_decode(self, key: str, decode: Callable[[], np.ndarray]) -> np.ndarray:
+        pixels = self.load(key)
+        if pixels is None:
+            pixels = decode()
+            self.store(key, pixels)
+        return pixels
+
+    def invalidate(self, key: str) -> None:
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def clear(self) -> None:
+        for path, _, _ in self._entries():
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self._directory, key + '.npy')
+
+    def _entries(self):
+        entries = []
+        for entry in os.scandir(self._directory):
+            if entry.name.endswith('.npy'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((entry.path, stat.st_mtime, stat.st_size))
+        return entries
+
+    def _trim(self, keep: str) -> None:
+        entries = sorted(self._entries(), key=lambda entry: entry[1])
+        total = sum(size for _, _, size in entries)
+        keep_path = self._path(keep)
+        for path, _, size in entries:
+            if total <= self._max_bytes:
+                break
+            if path == keep_path:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
@@ -0,0 +1,20 @@
+import os
+from concurrent.futures import Executor, ThreadPoolExecutor
+from threading import Lock
+
+_default_executor = None
+_default_executor_lock = Lock()
+
+
+def get_default_executor() -> Executor:
+    global _default_executor
+    with _default_executor_lock:
+        if _default_executor is None:
+            _default_executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix='pyy_chr')
+        return _default_executor
+
+
+def set_default_executor(executor: Executor) -> None:
+    global _default_executor
+    with _default_executor_lock:
+        _default_executor = executor
@@ -0,0 +1,98 @@
+import time
+from typing import Dict, NamedTuple
+
+from events import Events
+
+
+class _NullTimer:
+    def __enter__(self) -> '_NullTimer':
+        return self
+
+    def __exit__(self, *_) -> None:
+        pass
+
+
+class _Timer:
+    def __init__(self, owner: 'Instrumentation', name: str, tags: dict) -> None:
+        self._owner = owner
+        self._name = name
+        self._tags = tags
+        self._start = 0.0
+
+    def __enter__(self) -> '_Timer':
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *_) -> None:
+        self._owner.events.on_timing(self._name, time.perf_counter() - self._start, self._tags)
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class Instrumentation:
+    def __init__(self) -> None:
+        self.events = Events(['on_timing', 'on_count'])
+        self.enabled = False
+
+    def timed(self, name: str, **tags):
+        # Disabled instrumentation hands back a shared no-op context, so hot paths pay one attribute check.
+        return _Timer(self, name, tags) if self.enabled else _NULL_TIMER
+
+    def count(self, name: str, value: int = 1, **tags) -> None:
+        if self.enabled:
+            self.events.on_count(name, value, tags)
+
+
+instrumentation = Instrumentation()
+
+
+class TimingSummary(NamedTuple):
+    calls: int
+    total: float
+    max: float
+
+
+class TimingRecorder:
+    def __init__(self, source: Instrumentation = None) -> None:
+        self._source = instrumentation if source is None else source
+        self._timings = {}
+        self._counts = {}
+        self._was_enabled = False
+
+    def __enter__(self) -> 'TimingRecorder':
+        self.attach()
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.detach()
+
+    @property
+    def timings(self) -> Dict[str, TimingSummary]:
+        return dict(self._timings)
+
+    @property
+    def counts(self) -> Dict[str, int]:
+        return dict(self._counts)
+
+    def attach(self) -> None:
+        self._was_enabled = self._source.enabled
+        self._source.events.on_timing += self._on_timing
+        self._source.events.on_count += self._on_count
+        self._source.enabled = True
+
+    def detach(self) -> None:
+        self._source.events.on_timing -= self._on_timing
+        self._source.events.on_count -= self._on_count
+        self._source.enabled = self._was_enabled
+
+    def reset(self) -> None:
+        self._timings = {}
+        self._counts = {}
+
+    def _on_timing(self, name: str, seconds: float, _: dict) -> None:
+        summary = self._timings.get(name, TimingSummary(0, 0.0, 0.0))
+        self._timings[name] = TimingSummary(summary.calls + 1, summary.total + seconds, max(summary.max, seconds))
+
+    def _on_count(self, name: str, value: int, _: dict) -> None:
+        self._counts[name] = self._counts.get(name, 0) + value
@@ -0,0 +1,56 @@
+import mmap
+
+from pyy_chr.core.buffer import Buffer
+
+
+class MappedBuffer(Buffer):
+    def __init__(self, path: str, writable: bool = False, history_limit: int = Buffer.DEFAULT_HISTORY_LIMIT) -> None:
+        self._path = path
+        self._writable = writable
+
+        self._file = open(path, 'r+b' if writable else 'rb')
+        try:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+        except Exception:
+            self._file.close()
+            raise
+
+        super().__init__(self._mmap, history_limit)
+
+    def __enter__(self) -> 'MappedBuffer':
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+    @property
+    def path(self) -> str:
+        return self._path
+
+    @property
+    def writable(self) -> bool:
+        return self._writable
+
+    @property
+    def closed(self) -> bool:
+        return self._mmap.closed
+
+    def view(self, start: int = 0, end: int = None) -> memoryview:
+        return memoryview(self._mmap)[start:end]
+
+    def begin_write(self) -> Buffer.BufferWriter:
+        if not self._writable:
+            raise Exception('Buffer {0} was opened read-only!'.format(self._path))
+        return super().begin_write()
+
+    def flush(self) -> None:
+        if self._writable:
+            self._mmap.flush()
+
+    def close(self) -> None:
+        try:
+            if not self._mmap.closed:
+                self.flush()
+                self._mmap.close()
+        finally:
+            self._file.close()
@@ -1,14 +1,42 @@
 from abc import ABC, abstractmethod
-from typing import Tuple
+from concurrent.futures import Executor, Future
+from typing import List, Optional, Sequence, Tuple
 
 from events import Events
+import numpy as np
 from PIL import Image
 
-from pyy_chr.core import Buffer, PixelColorFormatException
+from pyy_chr.core import Buffer, ByteRange, PixelColorFormatException, get_default_executor, instrumentation, \
+    ranges_to_blocks
 
 PixelColor = Tuple[int, ...]
 Coordinate = Tuple[int, int]
 Size = Tuple[int, int]
+Box = Tuple[int, int, int, int]
+
+
+def merge_boxes(boxes: Sequence[Box], max_boxes: int = None) -> List[Box]:
+    merged = []
+    for box in sorted(boxes):
+        if box[2] <= box[0] or box[3] <= box[1]:
+            continue
+
+        # Absorb every existing box that overlaps or touches the new one, then re-check the grown box.
+        changed = True
+        while changed:
+            changed = False
+            for index, other in enumerate(merged):
+                if box[0] <= other[2] and other[0] <= box[2] and box[1] <= other[3] and other[1] <= box[3]:
+                    box = (min(box[0], other[0]), min(box[1], other[1]), max(box[2], other[2]), max(box[3], other[3]))
+                    del merged[index]
+                    changed = True
+                    break
+        merged.append(box)
+
+    if max_boxes is not None and len(merged) > max_boxes:
+        return [(min(box[0] for box in merged), min(box[1] for box in merged),
+                 max(box[2] for box in merged), max(box[3] for box in merged))]
+    return merged
 
 
 class PixelProvider(ABC):
@@ -17,6 +45,10 @@ class PixelProvider(ABC):
 
         self.events = Events(['on_invalidated'])
 
+        self._version = 0
+        self._lut_cache = {}
+        self._lut_cache_version = 0
+
     @property
     @abstractmethod
     def size(self) -> Size:
@@ -35,12 +67,87 @@ class PixelProvider(ABC):
     def generate_point(self, point: Coordinate, page: int = 0) -> PixelColor:
         pass
 
+    def generate_region(self, image: Image, box: Box, page: int = 0) -> None:
+        if tuple(box) == (0, 0) + tuple(self.size):
+            self.generate_image(image, page)
+            return
+
+        full_image = Image.new(self.color_format, self.size)
+        self.generate_image(full_image, page)
+        image.paste(full_image.crop(box), box[:2])
+
+    def generate_points(self, points, page: int = 0) -> np.ndarray:
+        xs, ys = self._split_points(points)
+        colors = [self.generate_point((int(x), int(y)), page) for x, y in zip(xs, ys)]
+        return np.array([(color,) if isinstance(color, int) else color for color in colors],
+                        dtype=np.uint8).reshape(len(xs), len(self.color_format))
+
+    def read_region(self, box: Box, page: int = 0) -> np.ndarray:
+        if type(self).generate_points is PixelProvider.generate_points:
+            # Only per-point lookups are available, so rendering the region through PIL is far cheaper.
+            self._verify_box(box)
+            image = Image.new(self.color_format, self.size)
+            self.generate_region(image, box, page)
+            return np.asarray(image.crop(box)).reshape(box[3] - box[1], box[2] - box[0], len(self.color_format))
+
+        ys, xs = np.mgrid[box[1]:box[3], box[0]:box[2]]
+        colors = self.generate_points(np.stack((xs.ravel(), ys.ravel()), axis=-1), page)
+        return colors.reshape(box[3] - box[1], box[2] - box[0], len(self.color_format))
+
+    def palette_lut(self, column: int = 0) -> np.ndarray:
+        # Colors down one column, padded to at least 256 entries so any 8-bit index can be looked up directly.
+        if self._lut_cache_version != self._version:
+            self._lut_cache = {}
+            self._lut_cache_version = self._version
+
+        lut = self._lut_cache.get(column)
+        if lut is None:
+            with instrumentation.timed('palette.build_lut', column=column):
+                height = self.size[1]
+                colors = self.generate_points(np.stack((np.full(height, column), np.arange(height)), axis=-1))
+
+                lut = np.zeros((max(256, height), colors.shape[1]), dtype=np.uint8)
+                lut[:height] = colors
+                lut.flags.writeable = False
+            self._lut_cache[column] = lut
+        elif instrumentation.enabled:
+            instrumentation.count('palette.lut_hit')
+        return lut
+
+    def flat_palette(self, column: int = 0) -> List[int]:
+        return self.palette_lut(column)[:self.size[1]].ravel().tolist()
+
+    def generate_image_async(self, image: Image, page: int = 0, executor: Executor = None) -> Future:
+        return (executor or get_default_executor()).submit(self.generate_image, image, page)
+
+    def generate_region_async(self, image: Image, box: Box, page: int = 0, executor: Executor = None) -> Future:
+        return (executor or get_default_executor()).submit(self.generate_region, image, box, page)
+
     @property
     def page_count(self) -> int:
         return 1
 
-    def _invalidate(self) -> None:
-        self.events.on_invalidated(self)
+    @property
+    def version(self) -> int:
+        return self._version
+
+    def _invalidate(self, regions: Optional[Sequence[Box]] = None, pages: Optional[Sequence[int]] = None) -> None:
+        self._version += 1
+        self.events.on_invalidated(self, regions, pages)
+
+    def _split_points(self, points) -> Tuple[np.ndarray, np.ndarray]:
+        points = np.asarray(points, dtype=np.intp).reshape(-1, 2)
+        xs, ys = points[:, 0], points[:, 1]
+
+        width, height = self.size
+        if len(points) and (xs.min() < 0 or ys.min() < 0 or xs.max() >= width or ys.max() >= height):
+            raise IndexError('Points fall outside of provider bounds {0}.'.format(self.size))
+        return xs, ys
+
+    def _verify_box(self, box: Box) -> None:
+        width, height = self.size
+        if not (0 <= box[0] <= box[2] <= width and 0 <= box[1] <= box[3] <= height):
+            raise IndexError('Box {0} falls outside of provider bounds {1}.'.format(tuple(box), self.size))
 
     def _verify_color_format(self, color: PixelColor):
         if len(self.color_format) != len(color):
@@ -53,6 +160,12 @@ class WritablePixelProvider:
     def inject_point(self, point: Coordinate, value: PixelColor, page: int = 0):
         pass
 
+    def inject_image(self, image: Image, page: int = 0) -> None:
+        # Buffer-backed providers can batch these; see Buffer.batch().
+        for y in range(image.size[1]):
+            for x in range(image.size[0]):
+                self.inject_point((x, y), image.getpixel((x, y)), page)
+
 
 class SolidColor(PixelProvider):
     def __init__(self, size: Size, color_format: str, color: PixelColor = None):
@@ -88,6 +201,18 @@ class SolidColor(PixelProvider):
     def generate_image(self, image: Image, page: int = 0) -> None:
         image.paste(self._color, (0, 0) + self._size)
 
+    def generate_region(self, image: Image, box: Box, page: int = 0) -> None:
+        image.paste(self._color, box)
+
+    def generate_points(self, points, page: int = 0) -> np.ndarray:
+        xs, _ = self._split_points(points)
+        return np.tile(np.array(self._color, dtype=np.uint8), (len(xs), 1))
+
+    def read_region(self, box: Box, page: int = 0) -> np.ndarray:
+        self._verify_box(box)
+        return np.broadcast_to(np.array(self._color, dtype=np.uint8),
+                               (box[3] - box[1], box[2] - box[0], len(self._color)))
+
     def generate_point(self, point: Coordinate, page: int = 0) -> PixelColor:
         return self._color
 
@@ -110,12 +235,16 @@ class ValueRange(PixelProvider):
 
     def generate_image(self, image: Image, page: int = 0) -> None:
         size = self.size
-        for y in range(size[1]):
-            for x in range(size[0]):
-                image.put_pixel((x, y), self.generate_point((x, y), page))
+        values = np.arange(self._values.start, self._values.stop, self._values.step)[:size[0] * size[1]]
+        image.paste(Image.frombytes(self.color_format, size, values.astype(np.uint8).tobytes()))
 
     def generate_point(self, point: Coordinate, page: int = 0) -> PixelColor:
-        return point[0] if self._wrap_value is None else point[1] * self._wrap_value + point[0]
+        return self._values[point[0] if self._wrap_value is None else point[1] * self._wrap_value + point[0]]
+
+    def generate_points(self, points, page: int = 0) -> np.ndarray:
+        xs, ys = self._split_points(points)
+        indices = xs if self._wrap_value is None else ys * self._wrap_value + xs
+        return (self._values.start + indices * self._values.step).astype(np.uint8)[:, np.newaxis]
 
 
 class ColorGradient(PixelProvider):
@@ -131,11 +260,9 @@ class ColorGradient(PixelProvider):
 
         self._color_format = color_format
 
-        self._values = []
-        for point_index in range(points):
-            t = point_index / (points - 1)
-            val = tuple(int(round(min_color[c] * (1 - t) + max_color[c] * t)) for c in range(len(min_color)))
-            self._values.append(val)
+        t = (np.arange(points) / max(points - 1, 1))[:, np.newaxis]
+        values = np.array(min_color, dtype=np.float64) * (1 - t) + np.array(max_color, dtype=np.float64) * t
+        self._values = np.rint(values).astype(np.uint8)
 
     @property
     def size(self) -> Size:
@@ -146,11 +273,14 @@ class ColorGradient(PixelProvider):
         return self._color_format
 
     def generate_image(self, image: Image, page: int = 0) -> None:
-        for index, value in enumerate(self._values):
-            image.putpixel((1, index), value)
+        image.paste(Image.frombytes(self._color_format, self.size, self._values.tobytes()))
 
     def generate_point(self, point: Coordinate, page: int = 0) -> PixelColor:
-        return self._values[point[1]]
+        return tuple(int(value) for value in self._values[point[1]])
+
+    def generate_points(self, points, page: int = 0) -> np.ndarray:
+        _, ys = self._split_points(points)
+        return self._values[ys]
 
 
 class BufferInterpreter(PixelProvider, WritablePixelProvider):
@@ -179,18 +309,65 @@ class BufferInterpreter(PixelProvider, WritablePixelProvider):
     def generate_image(self, image: Image, page: int = 0) -> None:
         image.paste(self._image)
 
+    def generate_region(self, image: Image, box: Box, page: int = 0) -> None:
+        image.paste(self._image.crop(box), box[:2])
+
+    def generate_points(self, points, page: int = 0) -> np.ndarray:
+        xs, ys = self._split_points(points)
+
+        # Read straight from the buffer; it is always current and viewing it is zero-copy.
+        width, height = self.size
+        data = np.frombuffer(self._buffer.view(0, height * self._bytes_per_row), dtype=np.uint8)
+        return data.reshape(height, width, len(self._color_format))[ys, xs]
+
+    def read_region(self, box: Box, page: int = 0) -> np.ndarray:
+        self._verify_box(box)
+
+        # Only the region is copied; a view would pin the buffer's memory and keep a mapped file from closing.
+        width, height = self.size
+        data = np.frombuffer(self._buffer.view(0, height * self._bytes_per_row), dtype=np.uint8)
+        return data.reshape(height, width, len(self._color_format))[box[1]:box[3], box[0]:box[2]].copy()
+
     def generate_point(self, point: Coordinate, page: int = 0) -> PixelColor:
         return self._image.getpixel(point)
 
     def inject_point(self, point: Coordinate, color: PixelColor, page: int = 0):
         self._verify_color_format(color)
 
-        loc = point[1] * self._width * len(self._color_format) + point[0]
+        loc = point[1] * self._bytes_per_row + point[0] * len(self._color_format)
         self._buffer.write(loc, color)
 
-    def _load_buffer(self) -> None:
-        self._image = Image.frombytes(self._color_format, self.size, bytes(self._buffer.data))
+    def inject_image(self, image: Image, page: int = 0) -> None:
+        if image.mode != self._color_format:
+            raise PixelColorFormatException('Image mode {0} does not match format {1}.'
+                                            .format(image.mode, self._color_format))
+        if image.size[0] > self._width or image.size[1] > self.size[1]:
+            raise IndexError('Image of size {0} does not fit in {1}.'.format(image.size, self.size))
 
-    def _on_buffer_changed(self) -> None:
-        self._load_buffer()
-        self._invalidate()
+        data = image.tobytes()
+        row_length = image.size[0] * len(self._color_format)
+
+        with self._buffer.batch() as writer:
+            if image.size[0] == self._width:
+                writer.write(0, data)
+            else:
+                for row in range(image.size[1]):
+                    writer.write(row * self._bytes_per_row, data[row * row_length:(row + 1) * row_length])
+
+    def _load_buffer(self) -> None:
+        with instrumentation.timed('buffer_interpreter.load', rows=self.size[1]):
+            self._image = Image.frombytes(self._color_format, self.size, self._buffer.view())
+
+    def _load_rows(self, first_row: int, last_row: int) -> None:
+        data = self._buffer.view(first_row * self._bytes_per_row, last_row * self._bytes_per_row)
+        with instrumentation.timed('buffer_interpreter.load', rows=last_row - first_row):
+            self._image.paste(Image.frombytes(self._color_format, (self._width, last_row - first_row), data),
+                              (0, first_row))
+
+    def _on_buffer_changed(self, changed_ranges: Sequence[ByteRange]) -> None:
+        regions = []
+        for first_row, last_row in ranges_to_blocks(changed_ranges, self._bytes_per_row, self.size[1]):
+            self._load_rows(first_row, last_row)
+            regions.append((0, first_row, self._width, last_row))
+        if regions:
+            self._invalidate(regions=regions)
@@ -1,13 +1,51 @@
+from typing import Iterable, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
 from PIL import Image
 
-from pyy_chr.core import Coordinate, PixelColor, PixelColorFormatException, PixelProvider, Size
+from pyy_chr.core import Box, CacheStats, Coordinate, LRUCache, PixelColor, PixelColorFormatException, PixelProvider, \
+    Size, instrumentation
+
+
+class TileAttributes(NamedTuple):
+    tile_mask: int = -1
+    palette_shift: int = 0
+    palette_mask: int = 0
+    hflip_bit: Optional[int] = None
+    vflip_bit: Optional[int] = None
+    priority_bit: Optional[int] = None
+
+
+# SNES background map words: vhopppcc cccccccc.
+SNES_TILE_ATTRIBUTES = TileAttributes(tile_mask=0x3ff, palette_shift=10, palette_mask=0x7,
+                                      priority_bit=13, hflip_bit=14, vflip_bit=15)
+# GBA text-mode background entries: ppppvhtt tttttttt.
+GBA_TILE_ATTRIBUTES = TileAttributes(tile_mask=0x3ff, palette_shift=12, palette_mask=0xf, hflip_bit=10, vflip_bit=11)
+
+# Flip flags packed into the low bits of a tile variant (tile * 4 + flip).
+FLIP_H = 1
+FLIP_V = 2
 
 
 class TileMapper(PixelProvider):
+    # Beyond this many dirty rectangles, a single full-frame invalidation is cheaper for consumers.
+    MAX_DIRTY_REGIONS = 64
+    # Tile edits are mapped to dirty regions across at most this many map pages.
+    MAX_DIRTY_PAGES = 16
+
     def __init__(self, map_source: PixelProvider = None, tile_source: PixelProvider = None,
-                 palette_source: PixelProvider = None) -> None:
+                 palette_source: PixelProvider = None, tile_cache: LRUCache = None,
+                 attributes: TileAttributes = None) -> None:
         super().__init__()
 
+        self._tile_cache = LRUCache(capacity=4096, name='tile_mapper.tiles') if tile_cache is None else tile_cache
+        # Owner token in every key keeps mappers that share one cache apart (an id() could be reused).
+        self._tile_owner = object()
+        self._tile_epoch = 0
+        self._map_data = {}
+        self._map_data_key = None
+        self._attributes = TileAttributes() if attributes is None else attributes
+
         self._map_source = None
         self._tile_source = None
         self._palette_source = None
@@ -28,14 +66,40 @@ class TileMapper(PixelProvider):
     def color_format(self) -> str:
         return '' if self._palette_source is None else self._palette_source.color_format
 
+    @property
+    def page_count(self) -> int:
+        return 1 if self._map_source is None else self._map_source.page_count
+
+    @property
+    def attributes(self) -> TileAttributes:
+        return self._attributes
+
+    @attributes.setter
+    def attributes(self, attributes: TileAttributes) -> None:
+        self._attributes = TileAttributes() if attributes is None else attributes
+        self._invalidate()
+
+    @property
+    def tile_cache(self) -> LRUCache:
+        return self._tile_cache
+
+    @property
+    def cache_stats(self) -> CacheStats:
+        return self._tile_cache.stats
+
+    def invalidate_tile(self, tile: int) -> None:
+        if self._evict_tile(tile):
+            self._invalidate(regions=self._tile_regions([tile]))
+
     @property
     def map_source(self) -> PixelProvider:
         return self._map_source
 
     @map_source.setter
     def map_source(self, map_source: PixelProvider) -> None:
-        if map_source is not None and len(map_source.color_format) != 1:
-            raise PixelColorFormatException('Map data format should be single-valued. Provided data has format \'{0}\'.'
+        if map_source is not None and len(map_source.color_format) not in (1, 2):
+            raise PixelColorFormatException('Map data format should be single-valued, or two channels holding a '
+                                            'little-endian 16-bit entry. Provided data has format \'{0}\'.'
                                             .format(map_source.color_format))
 
         if self._map_source is not None:
@@ -70,7 +134,6 @@ class TileMapper(PixelProvider):
         if self.palette_source is not None:
             self._palette_source.events.on_invalidated -= self._on_invalidated
         self._palette_source = palette_source
-        self._reset_tile_cache()
         if self._palette_source is not None:
             self._palette_source.events.on_invalidated += self._on_invalidated
 
@@ -78,38 +141,241 @@ class TileMapper(PixelProvider):
         if self.tile_source is None or self.map_source is None or self.palette_source is None:
             return
 
-        for row in range(self._map_source.size[1]):
-            for col in range(self._map_source.size[0]):
-                tile = self._map_source.generate_point((col, row))
-                image.paste(self._get_cached_tile(tile if isinstance(tile, int) else tile[0]),
-                            (col * self._tile_source.size[0], row * self._tile_source.size[1]))
+        with instrumentation.timed('tile_mapper.generate_image', page=page):
+            image.paste(self._render_cells(self._read_map(page)))
+
+    def generate_region(self, image: Image, box: Box, page: int = 0) -> None:
+        if self.tile_source is None or self.map_source is None or self.palette_source is None:
+            return
+
+        with instrumentation.timed('tile_mapper.generate_region', page=page):
+            image.paste(self._to_image(self._region_colors(box, page)), box[:2])
+
+    def read_region(self, box: Box, page: int = 0) -> np.ndarray:
+        self._verify_box(box)
+        if self.tile_source is None or self.map_source is None or self.palette_source is None:
+            return np.zeros((box[3] - box[1], box[2] - box[0], len(self.color_format)), dtype=np.uint8)
+
+        with instrumentation.timed('tile_mapper.read_region', page=page):
+            return self._region_colors(box, page)
+
+    def generate_layers(self, image: Image, pages: Sequence[int] = None, transparent_index: int = 0) -> None:
+        if self.tile_source is None or self.map_source is None or self.palette_source is None:
+            return
+
+        pages = range(self.page_count) if pages is None else pages
+        with instrumentation.timed('tile_mapper.generate_layers', layers=len(pages)):
+            self._composite_layers(image, pages, transparent_index)
+
+    def _composite_layers(self, image: Image, pages: Sequence[int], transparent_index: int) -> None:
+        layers = [self._compose(self._read_map(page)) for page in pages]
+        if not layers:
+            return
+
+        indices = np.stack([layer[0] for layer in layers])
+        palettes = None if all(layer[1] is None for layer in layers) else \
+            np.stack([np.zeros_like(indices[0]) if layer[1] is None else layer[1] for layer in layers])
+        priorities = np.stack([np.zeros_like(indices[0]) if layer[2] is None else layer[2] for layer in layers])
+
+        # Later pages draw over earlier ones and priority tiles over everything without it. Where every layer is
+        # transparent the bottom layer wins, so its transparent color acts as the backdrop.
+        layer_order = np.arange(1, len(layers) + 1)[:, np.newaxis, np.newaxis]
+        rank = np.where(indices != transparent_index, priorities * len(layers) + layer_order, 0)
+        top = rank.argmax(axis=0)[np.newaxis]
+
+        frame_indices = np.take_along_axis(indices, top, axis=0)[0]
+        frame_palettes = None if palettes is None else np.take_along_axis(palettes, top, axis=0)[0]
+        image.paste(self._to_image(self._apply_palettes(frame_indices, frame_palettes)))
 
     def generate_point(self, point: Coordinate, page: int = 0) -> PixelColor:
-        tile_coord = point[0] // self._tile_source.size[0], point[1] // self._tile_source.size[1]
-        point_offset = point[0] % self._tile_source.size[0], point[1] % self._tile_source.size[1]
+        xs, ys = self._split_points([point])
+        x, y = int(xs[0]), int(ys[0])
+        tile_width, tile_height = self._tile_source.size
+
+        # One cell, one cached tile: no atlas or stacked palette tables for a single pixel.
+        variant, palette, _ = self._decode_cells(int(self._read_map(page)[y // tile_height, x // tile_width]))
+        color_index = 0
+        if (variant >> 2) < self._tile_source.page_count:
+            color_index = int(self._get_cached_tile(variant >> 2, variant & 3)[y % tile_height, x % tile_width])
+
+        # Passed straight through, so single-channel palettes still yield a plain int.
+        return self._palette_source.generate_point((0 if palette is None else palette, color_index))
+
+    def generate_points(self, points, page: int = 0) -> np.ndarray:
+        xs, ys = self._split_points(points)
+        tile_width, tile_height = self._tile_source.size
+
+        variants, palettes, _ = self._decode_cells(self._read_map(page)[ys // tile_height, xs // tile_width])
+        indices = self._build_atlas(variants)[variants, ys % tile_height, xs % tile_width]
+        return self._apply_palettes(indices, palettes)
+
+    def _read_map(self, page: int = 0) -> np.ndarray:
+        key = (self._map_source, self._map_source.version)
+        if self._map_data_key != key:
+            self._map_data = {}
+            self._map_data_key = key
+
+        values = self._map_data.get(page)
+        if values is None:
+            map_image = Image.new(self._map_source.color_format, self._map_source.size)
+            self._map_source.generate_image(map_image, page)
+
+            values = np.asarray(map_image).astype(np.intp)
+            if values.ndim == 3:
+                values = values[..., 0] | (values[..., 1] << 8)
+            self._map_data[page] = values
+        return values
+
+    def _decode_cells(self, values: np.ndarray) -> Tuple[np.ndarray, Optional[np.ndarray], Optional[np.ndarray]]:
+        attributes = self._attributes
+
+        variants = (values & attributes.tile_mask) * 4
+        if attributes.hflip_bit is not None:
+            variants |= ((values >> attributes.hflip_bit) & 1) * FLIP_H
+        if attributes.vflip_bit is not None:
+            variants |= ((values >> attributes.vflip_bit) & 1) * FLIP_V
+
+        palettes = None if attributes.palette_mask == 0 else \
+            (values >> attributes.palette_shift) & attributes.palette_mask
+        priorities = None if attributes.priority_bit is None else (values >> attributes.priority_bit) & 1
+
+        return variants, palettes, priorities
+
+    def _compose(self, values: np.ndarray) -> Tuple[np.ndarray, Optional[np.ndarray], Optional[np.ndarray]]:
+        tile_width, tile_height = self._tile_source.size
+        rows, cols = values.shape
+        variants, palettes, priorities = self._decode_cells(values)
+
+        # (row, col, y, x) -> (row, y, col, x) so each tile row lands in its place in the frame.
+        atlas = self._build_atlas(variants)
+        indices = atlas[variants].transpose(0, 2, 1, 3).reshape(rows * tile_height, cols * tile_width)
+
+        def expand(cells: Optional[np.ndarray]) -> Optional[np.ndarray]:
+            return None if cells is None else np.repeat(np.repeat(cells, tile_height, axis=0), tile_width, axis=1)
 
-        tile_image = self._get_cached_tile(self._map_source.generate_point(tile_coord)[0])
-        color_index = tile_image.getpixel(point_offset)
+        return indices, expand(palettes), expand(priorities)
 
-        return self.palette_source.generate_point((0, color_index))
+    def _region_colors(self, box: Box, page: int) -> np.ndarray:
+        tile_width, tile_height = self._tile_source.size
+        first_col, first_row = box[0] // tile_width, box[1] // tile_height
+        last_col, last_row = -(-box[2] // tile_width), -(-box[3] // tile_height)
 
-    def _get_cached_tile(self, tile: int) -> Image:
-        if tile not in self._tile_cache:
-            palette = sum([self._palette_source.generate_point((0, entry)) for entry in
-                           range(self._palette_source.size[1])], ())
+        indices, palettes, _ = self._compose(self._read_map(page)[first_row:last_row, first_col:last_col])
+        offset_x, offset_y = box[0] - first_col * tile_width, box[1] - first_row * tile_height
+        window = (slice(offset_y, offset_y + box[3] - box[1]), slice(offset_x, offset_x + box[2] - box[0]))
+        # Cropping before the palette lookup keeps the colour pass to just the requested pixels.
+        return self._apply_palettes(indices[window], None if palettes is None else palettes[window])
 
-            tile_image = Image.new(self._tile_source.color_format, self._tile_source.size)
-            tile_image.putpalette(palette)
+    def _render_cells(self, values: np.ndarray) -> Image:
+        indices, palettes, _ = self._compose(values)
+        return self._to_image(self._apply_palettes(indices, palettes))
 
-            self._tile_source.generate_image(tile_image, tile)
-            self._tile_cache[tile] = tile_image
+    def _apply_palettes(self, indices: np.ndarray, palettes: Optional[np.ndarray]) -> np.ndarray:
+        with instrumentation.timed('tile_mapper.apply_palettes', pixels=indices.size):
+            if palettes is None or not palettes.any():
+                return np.take(self._palette_source.palette_lut(), indices, axis=0)
 
-        return self._tile_cache[tile]
+            # Palette select picks the palette source's column; one table per column, stacked and indexed in one go.
+            luts = [self._palette_source.palette_lut(column) for column in range(int(palettes.max()) + 1)]
+            return np.take(np.concatenate(luts), palettes * len(luts[0]) + indices, axis=0)
+
+    def _to_image(self, colors: np.ndarray) -> Image:
+        return Image.frombytes(self.color_format, (colors.shape[1], colors.shape[0]), colors.tobytes())
+
+    def _build_atlas(self, variants: np.ndarray) -> np.ndarray:
+        tile_width, tile_height = self._tile_source.size
+
+        # Atlas indexed directly by tile variant; only variants that are actually used are filled in.
+        # Variants naming a tile past the end of the tile source stay blank.
+        atlas = np.zeros((int(variants.max(initial=0)) + 1, tile_height, tile_width), dtype=np.uint8)
+        for variant in np.flatnonzero(np.bincount(variants.ravel())):
+            if (int(variant) >> 2) < self._tile_source.page_count:
+                atlas[variant] = self._get_cached_tile(int(variant) >> 2, int(variant) & 3)
+        return atlas
+
+    def _get_cached_tile(self, tile: int, flip: int = 0) -> np.ndarray:
+        if flip == 0:
+            return self._tile_cache.get_or_create(self._tile_key(tile, 0), lambda: self._decode_tile(tile))
+        return self._tile_cache.get_or_create(self._tile_key(tile, flip),
+                                              lambda: self._flip_tile(self._get_cached_tile(tile), flip))
+
+    def _tile_key(self, tile: int, flip: int) -> Tuple[object, int, int, int]:
+        return self._tile_owner, tile, flip, self._tile_epoch
+
+    def _decode_tile(self, tile: int) -> np.ndarray:
+        tile_image = Image.new(self._tile_source.color_format, self._tile_source.size)
+        self._tile_source.generate_image(tile_image, tile)
+        return np.asarray(tile_image)
+
+    @staticmethod
+    def _flip_tile(pixels: np.ndarray, flip: int) -> np.ndarray:
+        if flip & FLIP_H:
+            pixels = pixels[:, ::-1]
+        if flip & FLIP_V:
+            pixels = pixels[::-1, :]
+        return np.ascontiguousarray(pixels)
+
+    def _evict_tile(self, tile: int) -> bool:
+        evicted = False
+        for flip in range(4):
+            evicted = self._tile_cache.invalidate(self._tile_key(tile, flip)) or evicted
+        return evicted
 
     def _reset_tile_cache(self) -> None:
-        self._tile_cache = {}
+        # Entries from older epochs are never looked up again and age out of the LRU on their own.
+        self._tile_epoch += 1
 
-    def _on_invalidated(self, sender: PixelProvider) -> None:
-        if sender != self._map_source:
-            self._reset_tile_cache()
-        self._invalidate()
+    def _tile_regions(self, tiles: Iterable[int]) -> Optional[List[Box]]:
+        if self._map_source is None or self._tile_source is None or self.page_count > self.MAX_DIRTY_PAGES:
+            return None
+
+        tiles = list(tiles)
+        cells = None
+        for page in range(self.page_count):
+            page_cells = np.isin(self._read_map(page) & self._attributes.tile_mask, tiles)
+            cells = page_cells if cells is None else cells | page_cells
+        return self._cell_regions(cells)
+
+    def _map_regions(self, regions: Sequence[Box]) -> List[Box]:
+        tile_width, tile_height = self._tile_source.size
+        return [(left * tile_width, top * tile_height, right * tile_width, bottom * tile_height)
+                for left, top, right, bottom in regions]
+
+    def _cell_regions(self, cells: np.ndarray) -> Optional[List[Box]]:
+        tile_width, tile_height = self._tile_source.size
+
+        # One rectangle per horizontal run of dirty cells.
+        regions = []
+        for row in np.flatnonzero(cells.any(axis=1)):
+            cols = np.flatnonzero(cells[row])
+            breaks = np.flatnonzero(np.diff(cols) != 1)
+            starts = np.concatenate(([cols[0]], cols[breaks + 1]))
+            ends = np.concatenate((cols[breaks], [cols[-1]])) + 1
+
+            for start, end in zip(starts, ends):
+                regions.append((int(start) * tile_width, int(row) * tile_height,
+                                int(end) * tile_width, (int(row) + 1) * tile_height))
+            if len(regions) > self.MAX_DIRTY_REGIONS:
+                return None
+
+        return regions
+
+    def _on_invalidated(self, sender: PixelProvider, regions: Optional[Sequence[Box]] = None,
+                        pages: Optional[Sequence[int]] = None) -> None:
+        if sender == self._tile_source:
+            if pages is None:
+                self._reset_tile_cache()
+                self._invalidate()
+            else:
+                for tile in pages:
+                    self._evict_tile(tile)
+                dirty = self._tile_regions(pages)
+                if dirty is None or dirty:
+                    self._invalidate(regions=dirty)
+        elif sender == self._map_source:
+            if regions is None or self._tile_source is None:
+                self._invalidate(pages=pages)
+            else:
+                self._invalidate(regions=self._map_regions(regions), pages=pages)
+        else:
+            self._invalidate()
@@ -1,9 +1,16 @@
+import threading
+import time
+
+from kivy.clock import Clock
 from kivy.graphics import Color, Rectangle
 from kivy.graphics.texture import Texture
 from kivy.properties import BooleanProperty, BoundedNumericProperty, NumericProperty, ObjectProperty, ReferenceListProperty
 from kivy.uix.widget import Widget
+import numpy as np
 from PIL import Image
 
+from pyy_chr.core import get_default_executor, instrumentation, merge_boxes
+
 
 class PixelDisplay(Widget):
     pixel_provider = ObjectProperty()
@@ -17,14 +24,34 @@ class PixelDisplay(Widget):
 
     page = BoundedNumericProperty(0, min=0, max=0)
 
+    # Upper bound on redraws per second; 0 redraws on every frame that has pending changes.
+    max_redraw_rate = NumericProperty(60)
+    # Pending dirty regions beyond this count are collapsed into their bounding box.
+    max_dirty_regions = NumericProperty(16)
+
+    # Render on a background executor and upload horizontal bands as they complete.
+    async_render = BooleanProperty(False)
+    async_band_height = NumericProperty(64)
+    executor = ObjectProperty(None, allownone=True)
+
     def __init__(self, **kwargs) -> None:
         super(PixelDisplay, self).__init__(**kwargs)
 
         self._current_provider = None
         self._current_texture = None
-        self._current_image = None
+        self._staging = None
+        self._display_mode = None
+        self._display_lut = None
         self._rectangle = None
 
+        self._redraw_event = None
+        self._pending_regions = []
+        self._last_redraw_time = 0.0
+
+        # Async bands carry the generation they were queued under; anything older is dropped on arrival.
+        self._render_generation = 0
+        self._pending_bands = set()
+
         self.bind(pixel_provider=self._on_provider_changed)
         self.bind(page=self._on_page_changed)
         self.bind(pos=self._on_rect_changed)
@@ -69,37 +96,76 @@ class PixelDisplay(Widget):
             self._current_provider.events.on_invalidated -= self._on_provider_invalidated
 
         self._current_provider = self.pixel_provider
+        self._discard_pending_bands()
         self.property('page').set_max(self, self._current_provider.page_count)
         if self.page > self._current_provider.page_count:
             self.page = self._current_provider.page_count - 1
-        self._redraw()
+        self._schedule_redraw()
 
         if self._current_provider is not None:
             self._current_provider.events.on_invalidated += self._on_provider_invalidated
 
     def _on_page_changed(self, *_):
-        self._redraw()
+        self._discard_pending_bands()
+        self._schedule_redraw()
 
-    def _on_provider_invalidated(self, _: object) -> None:
-        self._redraw()
+    def _on_provider_invalidated(self, sender: object, regions=None, pages=None) -> None:
+        if threading.current_thread() is not threading.main_thread():
+            Clock.schedule_once(lambda _: self._on_provider_invalidated(sender, regions, pages))
+            return
+
+        if pages is not None and self.page not in pages:
+            return
+        self._schedule_redraw(regions)
 
     def _on_texture_reloaded(self, _: Texture) -> None:
-        self._redraw()
+        self._schedule_redraw()
+
+    def _schedule_redraw(self, regions=None) -> None:
+        if regions is None or self._pending_regions is None:
+            self._pending_regions = None
+        else:
+            self._pending_regions = merge_boxes(self._pending_regions + list(regions), self.max_dirty_regions)
 
-    def _redraw(self):
-        if self._current_image is None or\
-                self._current_image.mode != self._current_provider.color_format or\
-                self._current_image.size != self._current_provider.size:
-            self._current_image = Image.new(self._current_provider.color_format, self._current_provider.size)
+        if self._redraw_event is None:
+            delay = 0 if self.max_redraw_rate <= 0 else \
+                max(0.0, self._last_redraw_time + 1.0 / self.max_redraw_rate - time.perf_counter())
+            self._redraw_event = Clock.schedule_once(self._flush_redraw, delay)
+
+    def _flush_redraw(self, _: float) -> None:
+        regions = self._pending_regions
+
+        self._redraw_event = None
+        self._pending_regions = []
+        self._last_redraw_time = time.perf_counter()
+
+        # Bands still in flight may finish after this pass's bands, so they are superseded and redrawn here.
+        if regions is not None and self._pending_bands:
+            regions = merge_boxes(regions + list(self._pending_bands), self.max_dirty_regions)
+        self._discard_pending_bands()
+
+        if self._current_provider is not None:
+            self._redraw(regions)
+
+    def _redraw(self, regions=None):
+        if self._display_mode != self._current_provider.color_format:
+            self._display_mode = self._current_provider.color_format
+            self._display_lut = self._make_display_lut(self._display_mode)
+            regions = None
 
         if self._current_texture is None or\
-                self._current_texture.size != self._current_provider.size:
-            self._current_texture = Texture.create(self._current_image.size, colorfmt='RGB')
+                tuple(self._current_texture.size) != tuple(self._current_provider.size):
+            width, height = self._current_provider.size
+            self._current_texture = Texture.create((width, height), colorfmt='RGB')
             self._current_texture.mag_filter = 'nearest'
             self._current_texture.uvpos = (0, 1)
             self._current_texture.uvsize = (1, -1)
             self._current_texture.add_reload_observer(self._on_texture_reloaded)
 
+            # Scratch for every upload: a region of any width is staged contiguously at its start, so nothing
+            # is allocated or copied twice per blit.
+            self._staging = np.empty(width * height * 3, dtype=np.uint8)
+
             self.canvas.clear()
             with self.canvas:
                 Color(1, 1, 1)
@@ -107,7 +173,81 @@ class PixelDisplay(Widget):
 
             self.texture_size_x, self.texture_size_y = self._current_texture.size
             self._on_rect_changed(None)
+            regions = None
 
         if self.texture_size_x > 0 and self.texture_size_y > 0:
-            self._current_provider.generate_image(self._current_image, self.page)
-            self._current_texture.blit_buffer(self._current_image.convert(self._current_texture.colorfmt).tobytes())
+            if regions is None:
+                regions = [(0, 0, self.texture_size_x, self.texture_size_y)]
+            for region in regions:
+                box = self._clip_region(region)
+                if box is None:
+                    continue
+
+                if self.async_render:
+                    self._render_region_async(box)
+                else:
+                    with instrumentation.timed('pixel_display.render', page=self.page):
+                        pixels = self._current_provider.read_region(box, self.page)
+                    self._upload_region(box, pixels)
+
+    def _clip_region(self, region):
+        left, top = max(region[0], 0), max(region[1], 0)
+        right, bottom = min(region[2], self.texture_size_x), min(region[3], self.texture_size_y)
+        if right <= left or bottom <= top:
+            return None
+        return int(left), int(top), int(right), int(bottom)
+
+    def _discard_pending_bands(self) -> None:
+        self._render_generation += 1
+        self._pending_bands = set()
+
+    def _render_region_async(self, box) -> None:
+        executor = self.executor or get_default_executor()
+        generation = self._render_generation
+        band_height = max(1, int(self.async_band_height))
+
+        for band_top in range(box[1], box[3], band_height):
+            band = (box[0], band_top, box[2], min(band_top + band_height, box[3]))
+            self._pending_bands.add(band)
+            # Each band comes back as its own array; workers never touch the image the main thread uploads from.
+            future = executor.submit(self._current_provider.read_region, band, self.page)
+            future.add_done_callback(
+                lambda f, band=band: Clock.schedule_once(lambda _: self._on_band_rendered(f, generation, band)))
+
+    def _on_band_rendered(self, future, generation: int, band) -> None:
+        if generation != self._render_generation:
+            return
+        self._pending_bands.discard(band)
+
+        self._upload_region(band, future.result())
+
+    @staticmethod
+    def _make_display_lut(mode: str):
+        if mode not in ('P', 'L'):
+            return None
+
+        # Exactly what PIL's convert('RGB') would produce for each index of a fresh image in this mode.
+        ramp = Image.new(mode, (256, 1))
+        ramp.putdata(range(256))
+        return np.asarray(ramp.convert('RGB')).reshape(256, 3)
+
+    def _upload_region(self, box, pixels: np.ndarray) -> None:
+        with instrumentation.timed('pixel_display.blit', pixels=(box[2] - box[0]) * (box[3] - box[1])):
+            self._blit_region(box, pixels)
+
+    def _blit_region(self, box, pixels: np.ndarray) -> None:
+        left, top, right, bottom = box
+        width, height = right - left, bottom - top
+
+        # Colours are converted straight into the scratch block; it is the only copy made before the upload.
+        staged = self._staging[:width * height * 3].reshape(height, width, 3)
+        if self._display_mode == 'RGB':
+            np.copyto(staged, pixels)
+        elif self._display_lut is not None:
+            np.take(self._display_lut, pixels[..., 0], axis=0, out=staged, mode='clip')
+        else:
+            patch = Image.frombytes(self._display_mode, (width, height), np.ascontiguousarray(pixels).tobytes())
+            np.copyto(staged, np.asarray(patch.convert('RGB')))
+
+        # The texture's V axis is flipped, so image rows map straight onto texture rows.
+        self._current_texture.blit_buffer(memoryview(staged.reshape(-1)), pos=(left, top), size=(width, height))
@@ -9,8 +9,15 @@ setup(name='pyy_chr',
       packages=find_packages(),
       install_requires=[
           'events',
+          'numpy',
           'Pillow'
       ],
+      entry_points={
+          'console_scripts': [
+              'pyy-chr-atlas=pyy_chr.cli.atlas:main',
+              'pyy-chr-batch=pyy_chr.cli.batch:main'
+          ]
+      },
       extras_require={
           'ui-kivy': [
               'kivy'